@@ -1,7 +1,6 @@
 import os
 
 import compress_json
-import compress_pickle
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -9,9 +8,19 @@ import pdb
 from typing import Dict, Any
 from sentence_transformers import SentenceTransformer
 import open_clip
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 from pathlib import Path
+from utils.ann_index import IVFIndex, index_path
+from utils.annotation_store import AnnotationStore, store_path
+from utils.asset_shards import DEFAULT_ROUTER_MARGIN, CategoryShards, shards_path
+from utils.embedding_cache import EMBEDDING_CACHE_DIR, EmbeddingCache
+from utils.quantization import has_int8_store, load_int8
+from utils.feature_store import (
+    bbox_sizes, has_feature_store, load_features, load_pickled_features, load_pooled, load_sizes, pooled_features
+)
 # borrow from holodeck https://arxiv.org/abs/2312.09067
 ABS_PATH_OF_HOLODECK = os.path.abspath(os.path.dirname(Path(__file__)))
 
@@ -71,6 +80,37 @@ def get_bbox_dims(obj_data: Dict[str, Any]):
 
     return {k: maxs[k] - mins[k] for k in ["x", "y", "z"]}
 
+# candidates reranked by size before the best k are kept
+SIZE_RERANK_CANDIDATES = 50
+
+# assets scored per block, so float16 features are widened to float32 one block at a time
+SCORE_CHUNK = 4096
+
+def as_tensor(array):
+    # memmaps are read-only, torch warns about that but only ever reads them here
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", UserWarning)
+        return torch.from_numpy(array)
+
+class TopKResults:
+    """Top-k hits as (queries, k) asset index and score arrays, index -1 past the last hit of a query."""
+
+    def __init__(self, indices, scores, asset_ids):
+        self.indices = indices
+        self.scores = scores
+        self.asset_ids = asset_ids
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, query_index):
+        """(uid, score) pairs of one query, best first, in the format of retrieve."""
+        return [
+            (self.asset_ids[asset_index], float(score))
+            for asset_index, score in zip(self.indices[query_index], self.scores[query_index])
+            if asset_index >= 0
+        ]
+
 class ObjathorRetriever:
     def __init__(
         self,
@@ -79,78 +119,369 @@ class ObjathorRetriever:
         clip_tokenizer,
         sbert_model,
         retrieval_threshold,
+        features_dir=OBJATHOR_FEATURES_DIR,
+        ann_nprobe=None,
+        embedding_cache=None,
+        n_shards=None,
+        router_margin=DEFAULT_ROUTER_MARGIN,
+        quantized=False,
+        prefilter=None,
+        score_threads=None,
+        clip_model_id="ViT-L-14/laion2b_s32b_b82k",
+        sbert_model_id="all-mpnet-base-v2",
     ):
-        objathor_annotations = compress_json.load(OBJATHOR_ANNOTATIONS_PATH)
-        self.database = {**objathor_annotations}
-
-        objathor_clip_features_dict = compress_pickle.load(
-            os.path.join(OBJATHOR_FEATURES_DIR, f"clip_features.pkl")
-        )  # clip features
-        objathor_sbert_features_dict = compress_pickle.load(
-            os.path.join(OBJATHOR_FEATURES_DIR, f"sbert_features.pkl")
-        )  # sbert features
-        assert (
-            objathor_clip_features_dict["uids"] == objathor_sbert_features_dict["uids"]
-        )
-
-        objathor_uids = objathor_clip_features_dict["uids"]
-        objathor_clip_features = objathor_clip_features_dict["img_features"].astype(
-            np.float32
-        )
-        objathor_sbert_features = objathor_sbert_features_dict["text_features"].astype(
-            np.float32
-        )
-        self.clip_features = torch.from_numpy(objathor_clip_features)
-        self.clip_features = F.normalize(self.clip_features, p=2, dim=-1)
+        if os.path.exists(store_path(OBJATHOR_ANNOTATIONS_PATH)):
+            # indexed store from python -m utils.annotation_store, records decoded on lookup
+            self.database = AnnotationStore(store_path(OBJATHOR_ANNOTATIONS_PATH))
+        else:
+            self.database = compress_json.load(OBJATHOR_ANNOTATIONS_PATH)
 
-        self.sbert_features = torch.from_numpy(objathor_sbert_features)
-        
-        self.asset_ids = objathor_uids 
+        if has_feature_store(features_dir):
+            # pre-normalized .npy files from python -m utils.feature_store, opened without reading them
+            objathor_uids, objathor_clip_features, objathor_sbert_features = load_features(features_dir)
+        else:
+            objathor_uids, objathor_clip_features, objathor_sbert_features = load_pickled_features(features_dir)
+        self.clip_features = as_tensor(objathor_clip_features)
+        self.sbert_features = as_tensor(objathor_sbert_features)
+
+        self.asset_ids = objathor_uids
+
+        # int8 codes and per-vector scales of python -m utils.quantization, scored instead of the floats when quantized.
+        # Only with the feature store, whose float memmaps stay on disk unless recall_report reads them
+        self.clip_codes = self.clip_scales = self.sbert_codes = self.sbert_scales = None
+        self.quantized = False
+        if quantized:
+            if not has_feature_store(features_dir):
+                print(f"The int8 features need the feature store of python -m utils.feature_store in {features_dir}, "
+                      f"using the float features")
+            elif has_int8_store(features_dir):
+                self.clip_codes, self.clip_scales, self.sbert_codes, self.sbert_scales = (
+                    as_tensor(array) for array in load_int8(features_dir)
+                )
+                self.quantized = True
+            else:
+                print(f"No int8 features in {features_dir}, using the float features")
+        # two-stage retrieval: only the prefilter best assets by pooled view of each query get the exact score
+        self.prefilter = prefilter
+        pooled = load_pooled(features_dir) if has_feature_store(features_dir) else None
+        self.clip_pooled = as_tensor(pooled) if pooled is not None else None
+        # (assets, 3) sorted bbox dimensions in cm aligned with the features, if stored. Otherwise the
+        # sizes of reranked candidates are read from the annotations and kept by asset index
+        self.asset_sizes = load_sizes(features_dir) if has_feature_store(features_dir) else None
+        self.size_cache = {}
+
+        # approximate search through the IVF index of python -m utils.ann_index, exact when None
+        self.ann_index = None
+        self.ann_nprobe = ann_nprobe
+        if ann_nprobe is not None:
+            if os.path.exists(index_path(features_dir)):
+                self.ann_index = IVFIndex.load(index_path(features_dir))
+            else:
+                print(f"No ANN index in {features_dir}, using exact search")
+
+        # category shards of python -m utils.asset_shards, queries score only their n_shards closest ones
+        self.shards = None
+        self.n_shards = n_shards
+        self.router_margin = router_margin
+        if n_shards is not None:
+            if os.path.exists(shards_path(features_dir)):
+                self.shards = CategoryShards.load(shards_path(features_dir))
+            else:
+                print(f"No category shards in {features_dir}, using full search")
+
+        # blocks of assets scored in parallel, torch kernels release the GIL. Each worker gets its share
+        # of torch's intra-op threads so score_threads blocks at once do not oversubscribe the cores,
+        # the calling thread and the text encoders keep the process setting
+        self.score_pool = None
+        if score_threads is not None and score_threads > 1:
+            intra_op_threads = max(1, torch.get_num_threads() // score_threads)
+            self.score_pool = ThreadPoolExecutor(
+                score_threads, initializer=torch.set_num_threads, initargs=(intra_op_threads,)
+            )
 
         self.clip_model = clip_model
         self.clip_preprocess = clip_preprocess
         self.clip_tokenizer = clip_tokenizer
         self.sbert_model = sbert_model
+        # an EmbeddingCache, the model ids are part of its keys
+        self.embedding_cache = embedding_cache
+        self.clip_model_id = clip_model_id
+        self.sbert_model_id = sbert_model_id
 
         self.retrieval_threshold = retrieval_threshold
 
         self.use_text = True
 
-    def retrieve(self, queries, threshold):
-        # pdb.set_trace()
+    def score_features(self, query_feature_clip, query_feature_sbert, clip_features, sbert_features,
+                       clip_scales=None, sbert_scales=None):
+        """
+        CLIP (max over views) and SBERT similarities of the queries to a block of asset features.
+        With scales the features are int8 codes and each dot product is multiplied by the scale of its vector.
+        """
+        clip_features = clip_features.float()
+        sbert_features = sbert_features.float()
+        clip_similarities = 100 * torch.einsum(
+            "ij, lkj -> ilk", query_feature_clip, clip_features
+        )
+        if clip_scales is not None:
+            clip_similarities = clip_similarities * clip_scales
+        clip_similarities = torch.max(clip_similarities, dim=-1).values
+        sbert_similarities = query_feature_sbert @ sbert_features.T
+        if sbert_scales is not None:
+            sbert_similarities = sbert_similarities * sbert_scales
+        return clip_similarities, sbert_similarities
+
+    def blocks(self, indices=None):
+        """Slices, or index tensors, of up to SCORE_CHUNK assets covering every asset or the assets at indices."""
+        count = len(self.asset_ids) if indices is None else len(indices)
+        for start in range(0, max(count, 1), SCORE_CHUNK):
+            if indices is None:
+                yield slice(start, start + SCORE_CHUNK)
+            else:
+                yield torch.from_numpy(np.asarray(indices[start:start + SCORE_CHUNK], dtype=np.int64))
+
+    def block_features(self, block):
+        """(clip, sbert, clip scales, sbert scales) of a block of assets, the scales are None unless quantized."""
+        if self.quantized:
+            return self.clip_codes[block], self.sbert_codes[block], self.clip_scales[block], self.sbert_scales[block]
+        return self.clip_features[block], self.sbert_features[block], None, None
+
+    def map_blocks(self, function, indices=None):
+        """function of every block of blocks(indices), in order, run on the score pool if there is one."""
+        if self.score_pool is None:
+            return [function(block) for block in self.blocks(indices)]
+        return list(self.score_pool.map(function, self.blocks(indices)))
+
+    def score_assets(self, query_feature_clip, query_feature_sbert, indices=None):
+        """Similarities to every asset, or only to the assets at indices, one SCORE_CHUNK block at a time."""
+        scores = self.map_blocks(
+            lambda block: self.score_features(query_feature_clip, query_feature_sbert, *self.block_features(block)),
+            indices
+        )
+        clip_similarities = torch.cat([clip for clip, _ in scores], dim=1)
+        sbert_similarities = torch.cat([sbert for _, sbert in scores], dim=1)
+        return clip_similarities, sbert_similarities
+
+    def get_pooled_features(self):
+        if self.clip_pooled is None:
+            self.clip_pooled = torch.from_numpy(pooled_features(self.clip_features.numpy()))
+        return self.clip_pooled
+
+    def candidate_groups(self, candidates):
+        """(query indices, asset indices or None for all) pairs, queries with the same candidates share one."""
+        groups = {}
+        for query_index, indices in enumerate(candidates):
+            key = None if indices is None else indices.tobytes()
+            groups.setdefault(key, ([], indices))[0].append(query_index)
+        return list(groups.values())
+
+    def prefilter_candidates(self, query_feature_clip, query_feature_sbert, candidates):
+        """
+        Coarse stage of two-stage retrieval: the self.prefilter best assets of every query among
+        its candidates (all if None), scored with one pooled CLIP vector per asset instead of
+        every view, plus SBERT.
+        """
+        pooled = self.get_pooled_features()
+
+        def coarse_scores(group_clip, group_sbert, block):
+            block_scores = 100 * group_clip @ pooled[block].float().T
+            if self.use_text:
+                _, sbert_features, _, sbert_scales = self.block_features(block)
+                sbert_similarities = group_sbert @ sbert_features.float().T
+                if sbert_scales is not None:
+                    sbert_similarities = sbert_similarities * sbert_scales
+                block_scores = block_scores + sbert_similarities
+            return block_scores
+
+        prefiltered = list(candidates)
+        for query_indices, indices in self.candidate_groups(candidates):
+            group_clip, group_sbert = query_feature_clip[query_indices], query_feature_sbert[query_indices]
+            coarse = torch.cat(
+                self.map_blocks(lambda block: coarse_scores(group_clip, group_sbert, block), indices), dim=1
+            )
+            best = torch.topk(coarse, min(self.prefilter, coarse.shape[1]), dim=1).indices.numpy()
+            for query_index, query_best in zip(query_indices, np.sort(best, axis=1)):
+                prefiltered[query_index] = query_best if indices is None else indices[query_best]
+        return prefiltered
+
+    def encode_clip(self, queries):
         with torch.no_grad():
             query_feature_clip = self.clip_model.encode_text(
                 self.clip_tokenizer(queries)
             )
 
             query_feature_clip = F.normalize(query_feature_clip, p=2, dim=-1)
+        return query_feature_clip.float()
 
-        clip_similarities = 100 * torch.einsum(
-            "ij, lkj -> ilk", query_feature_clip, self.clip_features
-        )
-        clip_similarities = torch.max(clip_similarities, dim=-1).values
-
-        query_feature_sbert = self.sbert_model.encode(
+    def encode_sbert(self, queries):
+        return self.sbert_model.encode(
             queries, convert_to_tensor=True, show_progress_bar=False
+        ).float().cpu()
+
+    def encode(self, queries):
+        """Normalized CLIP and SBERT text features of the queries, through the embedding cache if there is one."""
+        if self.embedding_cache is None:
+            return self.encode_clip(queries), self.encode_sbert(queries)
+        query_feature_clip = self.embedding_cache.encode(
+            self.clip_model_id, queries, lambda texts: self.encode_clip(texts).numpy()
+        )
+        query_feature_sbert = self.embedding_cache.encode(
+            self.sbert_model_id, queries, lambda texts: self.encode_sbert(texts).numpy()
+        )
+        return torch.from_numpy(query_feature_clip), torch.from_numpy(query_feature_sbert)
+
+    def query_candidates(self, queries):
+        """
+        (clip features, sbert features, candidates) of the queries, candidates holding the asset
+        indices each query scores, None for all assets.
+        """
+        query_feature_clip, query_feature_sbert = self.encode(queries)
+
+        candidates = [None] * len(queries)
+        if self.ann_index is not None:
+            candidates = self.ann_index.probe(query_feature_clip.numpy(), self.ann_nprobe)
+        elif self.shards is not None:
+            # None for the queries the router is not confident about, they score every asset
+            candidates = self.shards.route(query_feature_clip.numpy(), self.n_shards, self.router_margin)
+        if self.prefilter is not None:
+            candidates = self.prefilter_candidates(query_feature_clip, query_feature_sbert, candidates)
+        return query_feature_clip, query_feature_sbert, candidates
+
+    def similarities(self, query_feature_clip, query_feature_sbert, indices=None):
+        """
+        (clip_similarities, similarities): (queries, scored assets) tensors of the CLIP and of the
+        combined score against every asset or the assets at indices.
+        """
+        clip_similarities, sbert_similarities = self.score_assets(
+            query_feature_clip, query_feature_sbert, indices
         )
-        sbert_similarities = query_feature_sbert @ self.sbert_features.T
 
         if self.use_text:
             similarities = clip_similarities + sbert_similarities
         else:
             similarities = clip_similarities
+        return clip_similarities, similarities
+
+    def retrieve_batch(self, queries, threshold):
+        """
+        Like retrieve, but encodes and scores all queries in one pass and returns one list of
+        (uid, score) per query, sorted by descending score.
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        if not queries:
+            return []
+        query_feature_clip, query_feature_sbert, candidates = self.query_candidates(queries)
+
+        results = [[] for _ in queries]
+        for query_indices, indices in self.candidate_groups(candidates):
+            clip_similarities, similarities = self.similarities(
+                query_feature_clip[query_indices], query_feature_sbert[query_indices], indices
+            )
+            threshold_indices = torch.where(clip_similarities > threshold)
+            for row, asset_index in zip(*threshold_indices):
+                score = similarities[row, asset_index].item()
+                if indices is not None:
+                    asset_index = indices[int(asset_index)]
+                results[query_indices[int(row)]].append((self.asset_ids[asset_index], score))
 
-        threshold_indices = torch.where(clip_similarities > threshold)
+        # Sorting the results in descending order by score
+        return [sorted(query_results, key=lambda x: x[1], reverse=True) for query_results in results]
+
+    def topk_assets(self, query_feature_clip, query_feature_sbert, k, threshold, indices=None):
+        """
+        (scores, columns) of the k best assets per query among every asset or the assets at indices,
+        CLIP similarity at most threshold scoring -inf. Each block keeps its own top k and the
+        blocks are merged after, so the (queries, assets) score matrix is never built.
+        """
+        def block_topk(block):
+            clip_similarities, sbert_similarities = self.score_features(
+                query_feature_clip, query_feature_sbert, *self.block_features(block)
+            )
+            similarities = clip_similarities + sbert_similarities if self.use_text else clip_similarities
+            similarities = similarities.masked_fill(clip_similarities <= threshold, float("-inf"))
+            return torch.topk(similarities, min(k, similarities.shape[1]), dim=1)
+
+        blocks = self.map_blocks(block_topk, indices)
+        scores = torch.cat([block_scores for block_scores, _ in blocks], dim=1)
+        # blocks are SCORE_CHUNK columns wide, so a block's columns start at its position times SCORE_CHUNK
+        columns = torch.cat([block_columns + i * SCORE_CHUNK for i, (_, block_columns) in enumerate(blocks)], dim=1)
+        scores, best = torch.topk(scores, min(k, scores.shape[1]), dim=1)
+        return scores, torch.gather(columns, 1, best)
+
+    def retrieve_topk(self, queries, k=10, threshold=None):
+        """
+        The k best assets of every query whose CLIP similarity is above threshold, by tensor
+        top-k instead of walking every hit. Returns TopKResults, uids are only looked up when
+        a query's results are read.
+        """
+        if isinstance(queries, str):
+            queries = [queries]
+        threshold = self.retrieval_threshold if threshold is None else threshold
+        if not queries:
+            return TopKResults(np.empty((0, 0), dtype=np.int64), np.empty((0, 0), dtype=np.float32), self.asset_ids)
+        query_feature_clip, query_feature_sbert, candidates = self.query_candidates(queries)
+
+        # queries sharing candidates are scored together, then each query's top k is written to its row
+        scores = np.full((len(queries), k), float("-inf"), dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        for query_indices, group_indices in self.candidate_groups(candidates):
+            group_scores, columns = self.topk_assets(
+                query_feature_clip[query_indices], query_feature_sbert[query_indices], k, threshold, group_indices
+            )
+            group_scores, columns = group_scores.numpy(), columns.numpy()
+            if group_indices is not None:
+                columns = group_indices[columns]
+            scores[query_indices, :columns.shape[1]] = group_scores
+            indices[query_indices, :columns.shape[1]] = columns
+        indices[~np.isfinite(scores)] = -1
+        return TopKResults(indices, scores, self.asset_ids)
 
-        unsorted_results = []
-        for query_index, asset_index in zip(*threshold_indices):
-            score = similarities[query_index, asset_index].item()
-            unsorted_results.append((self.asset_ids[asset_index], score))
+    def retrieve(self, queries, threshold):
+        """(uid, score) hits of all queries in one list, sorted by descending score."""
+        results = [result for query_results in self.retrieve_batch(queries, threshold) for result in query_results]
+        return sorted(results, key=lambda x: x[1], reverse=True)
+
+    def get_asset_sizes(self, indices):
+        """(*indices.shape, 3) sorted bbox dimensions of the assets at indices, NaN for an asset without a bounding box."""
+        if self.asset_sizes is not None:
+            return np.asarray(self.asset_sizes)[indices]
+        missing = [int(index) for index in np.unique(indices) if int(index) not in self.size_cache]
+        if missing:
+            sizes = bbox_sizes(self.database, [self.asset_ids[index] for index in missing])
+            self.size_cache.update(zip(missing, sizes))
+        return np.stack([self.size_cache[int(index)] for index in indices.ravel()]).reshape(indices.shape + (3,))
+
+    def rerank_by_size(self, results, target_sizes):
+        """
+        TopKResults reranked with the compute_size_difference penalty, for all queries at once.
+        target_sizes holds one (length, width, height) in cm per query, an asset without a
+        bounding box gets no penalty.
+        """
+        indices = results.indices
+        if indices.size == 0:
+            return results
+        valid = indices >= 0
+        candidate_sizes = self.get_asset_sizes(np.where(valid, indices, 0))
+        target_sizes = np.sort(np.asarray(target_sizes, dtype=np.float32), axis=1)[:, None, :]
+        size_difference = np.nan_to_num(np.abs(candidate_sizes - target_sizes).mean(axis=2) / 100)
+        scores = np.where(valid, results.scores - size_difference * 10, -np.inf)
+        order = np.argsort(-scores, axis=1, kind="stable")
+        return TopKResults(
+            np.take_along_axis(indices, order, axis=1), np.take_along_axis(scores, order, axis=1), self.asset_ids
+        )
 
-        # Sorting the results in descending order by score
-        results = sorted(unsorted_results, key=lambda x: x[1], reverse=True)
-        # pdb.set_trace()
-        return results
+    def retrieve_candidates(self, queries, k=10, threshold=None, sizes=None):
+        """
+        The (uid, score) lists of the k best assets of every query, reranked among the best
+        SIZE_RERANK_CANDIDATES by rerank_by_size when sizes gives a (length, width, height) per query.
+        Plain lists, so utils.retrieval_server can answer with the same call.
+        """
+        if sizes is None:
+            results = self.retrieve_topk(queries, k, threshold)
+        else:
+            results = self.rerank_by_size(self.retrieve_topk(queries, max(k, SIZE_RERANK_CANDIDATES), threshold), sizes)
+        return [results[i][:k] for i in range(len(results))]
 
     def compute_size_difference(self, target_size, candidates):
         candidate_sizes = []
@@ -182,6 +513,33 @@ class ObjathorRetriever:
 
         return candidates_with_size_difference
 
+def load_retriever(ann_nprobe=None, embedding_cache_dir=EMBEDDING_CACHE_DIR, n_shards=None, retrieval_threshold=50,
+                   quantized=False, features_dir=OBJATHOR_FEATURES_DIR, prefilter=None, score_threads=None):
+    """ObjathorRetriever with the ViT-L-14 and all-mpnet-base-v2 text encoders of the pipeline."""
+    clip_model, _, clip_preprocess = open_clip.create_model_and_transforms(
+        "ViT-L-14", pretrained="laion2b_s32b_b82k"
+    )
+    clip_tokenizer = open_clip.get_tokenizer("ViT-L-14")
+
+    sbert_model = SentenceTransformer("all-mpnet-base-v2", device="cpu")
+
+    return ObjathorRetriever(
+        clip_model=clip_model,
+        clip_preprocess=clip_preprocess,
+        clip_tokenizer=clip_tokenizer,
+        sbert_model=sbert_model,
+        retrieval_threshold=retrieval_threshold,
+        features_dir=features_dir,
+        ann_nprobe=ann_nprobe,
+        embedding_cache=EmbeddingCache(embedding_cache_dir) if embedding_cache_dir else None,
+        clip_model_id="ViT-L-14/laion2b_s32b_b82k",
+        sbert_model_id="all-mpnet-base-v2",
+        n_shards=n_shards,
+        quantized=quantized,
+        prefilter=prefilter,
+        score_threads=score_threads
+    )
+
 if __name__ == "__main__":
     # initialize CLIP
     (
@@ -5,7 +5,10 @@ import argparse
 import re
 import json
 from utils.json_process import *
-from utils.background_projection import calcuate_background_box, process_boxes, visualization
+from utils.background_projection import combine_viewpoints, project_background_boxes, union_boxes, visualization
+from utils.backdrop_space import backdrop_occupancy, free_regions, snap_boxes
+from utils.embedding_cache import EMBEDDING_CACHE_DIR
+from utils.retrieval_server import RETRIEVAL_SOCKET, connect_retriever
 from utils.placement_rules import*
 from retrieve_obj import*
 from diffusers import StableDiffusionPipeline
@@ -17,6 +20,31 @@ def parse_arguments():
     parser.add_argument('--text', type=str, required=True, help='Input text description')
     parser.add_argument('--openai_api_key', type=str, required=True, help='OpenAI API key')
     parser.add_argument('--output_dir', type=str, required=True, help='Output directory')
+    parser.add_argument('--layout_seed', type=int, default=None, help='Seed of the foreground layout, random if not given')
+    parser.add_argument('--layout_candidates', type=int, default=1, help='Number of seeded layouts to try, the best one is kept')
+    parser.add_argument('--layout_workers', type=int, default=1, help='Processes used to search layout candidates')
+    parser.add_argument('--layout_solver', type=str, default='greedy', choices=['greedy', 'backtracking'],
+                        help='backtracking places large, tightly constrained entities first and revisits recent placements on failure')
+    parser.add_argument('--layout_exhaustive', action='store_true',
+                        help='Pick each position among all free ones instead of by random trials, faster on crowded stages')
+    parser.add_argument('--audience', type=str, default=None,
+                        help='JSON list of [x, y] audience positions in cm, the two front stage corners by default')
+    parser.add_argument('--ann_nprobe', type=int, default=None,
+                        help='Retrieve assets through the IVF index probing this many lists, exact search if not given')
+    parser.add_argument('--no_size_rerank', action='store_true',
+                        help='Pick assets by text similarity only, without preferring matching bounding boxes')
+    parser.add_argument('--embedding_cache_dir', type=str, default=EMBEDDING_CACHE_DIR,
+                        help='Directory of cached query embeddings, EMBEDDING_CACHE_DIR or ~/.cache/stagedesigner/embeddings by default')
+    parser.add_argument('--retrieval_shards', type=int, default=None,
+                        help='Score only the assets of this many closest category shards, full search if not given')
+    parser.add_argument('--retrieval_socket', type=str, default=RETRIEVAL_SOCKET,
+                        help='Unix socket of python -m utils.retrieval_server, assets are retrieved in-process if none is running')
+    parser.add_argument('--int8_features', action='store_true',
+                        help='Score the int8 features of python -m utils.quantization instead of the float ones')
+    parser.add_argument('--retrieval_prefilter', type=int, default=None,
+                        help='Score all views only for this many assets per query, picked by pooled view, e.g. 300')
+    parser.add_argument('--score_threads', type=int, default=None,
+                        help='Threads scoring blocks of assets in parallel, e.g. the number of cores')
     return parser.parse_args()
 
 def scene_list_generator(scripts,client):
@@ -202,7 +230,7 @@ def ornament_generator(scripts, anchor_entities, client):
 
     return response.choices[0].message.content
 
-def background_generator(imagery_descriptions, foreground_entities, bounding_boxes, client):
+def background_generator(imagery_descriptions, foreground_entities, bounding_boxes, client, free_regions=None):
     background_prompt = f"""
     Task:
     You are an imaginative expert in creating stage backdrops. The stage backdrop is defined as a 1000x1000 cm canvas, with the top-left corner at (0,0) and the bottom-right corner at (999,999), where the y-coordinate increases downward.
@@ -215,6 +243,8 @@ def background_generator(imagery_descriptions, foreground_entities, bounding_box
         Entities: {foreground_entities}
         Bounding Boxes: {bounding_boxes}
         The bounding box coordinates [x1, y1, x2, y2] represent the top-left (x1, y1) and bottom-right (x2, y2) corners of each entity's bounding box.
+        Free Regions: {free_regions}
+        The free regions [x1, y1, x2, y2] are areas of the canvas that no foreground entity covers. Place the new entities inside them.
     2.Scene Creativity and Inspiration:
         Generate an imaginative scene description to enhance the overall atmosphere inspired by the imagery descriptions, but not limited to it. Feel free to explore unconventional ideas.
         Avoid using the same entities present in the foreground. The scene should introduce distinct, describable objects (natural, artificial, or imaginary).
@@ -262,27 +292,30 @@ def extract_non_digit(text):
     return text  
 
 
-def initialize_models():
+def initialize_models(ann_nprobe=None, embedding_cache_dir=EMBEDDING_CACHE_DIR, n_shards=None, retrieval_socket=RETRIEVAL_SOCKET,
+                      quantized=False, prefilter=None, score_threads=None):
     pipe = StableDiffusionPipeline.from_pretrained(
         "j-min/reco_sd14_laion", 
         torch_dtype=torch.float32,
         use_safetensors=False  
     ).to("cuda")
 
-    clip_model, _, clip_preprocess = open_clip.create_model_and_transforms(
-        "ViT-L-14", pretrained="laion2b_s32b_b82k"
-    )
-    clip_tokenizer = open_clip.get_tokenizer("ViT-L-14")
-
-    sbert_model = SentenceTransformer("all-mpnet-base-v2", device="cpu")
-
-    object_retriever = ObjathorRetriever(
-        clip_model=clip_model,
-        clip_preprocess=clip_preprocess,
-        clip_tokenizer=clip_tokenizer,
-        sbert_model=sbert_model,
-        retrieval_threshold=50 
-    )
+    # a running python -m utils.retrieval_server already has the encoders and features loaded
+    object_retriever = connect_retriever(retrieval_socket)
+    if object_retriever is not None:
+        mismatched = object_retriever.mismatched_options({
+            "ann_nprobe": ann_nprobe, "retrieval_shards": n_shards, "int8_features": quantized,
+            "retrieval_prefilter": prefilter, "score_threads": score_threads
+        })
+        if mismatched:
+            print(f"The retrieval server at {retrieval_socket} runs with {object_retriever.options}, "
+                  f"not {mismatched}; loading the retriever in-process instead")
+            object_retriever = None
+    if object_retriever is None:
+        object_retriever = load_retriever(ann_nprobe, embedding_cache_dir, n_shards, quantized=quantized,
+                                          prefilter=prefilter, score_threads=score_threads)
+    else:
+        print(f"Using the retrieval server at {retrieval_socket} with {object_retriever.options}")
 
     return pipe, object_retriever
 
@@ -292,7 +325,9 @@ def main(args):
 
     client = OpenAI(api_key=args.openai_api_key)
 
-    pipe, object_retriever = initialize_models()
+    pipe, object_retriever = initialize_models(args.ann_nprobe, args.embedding_cache_dir, args.retrieval_shards,
+                                               args.retrieval_socket, args.int8_features,
+                                               args.retrieval_prefilter, args.score_threads)
 
     scene_list = scene_list_generator(args.text, client)
     scene_list = extract_json(scene_list)
@@ -315,34 +350,55 @@ def main(args):
     with open(os.path.join(args.output_dir, 'ornament_text.json'), "w", encoding='utf-8') as f:
         json.dump(ornament_text, f, ensure_ascii=False, indent=4)
 
-    foreground_text = layout(anchor_text, ornament_text)
+    layout_records = []
+    foreground_text, layout_seed = layout(anchor_text, ornament_text, exhaustive=args.layout_exhaustive, seed=args.layout_seed,
+                                          n_candidates=args.layout_candidates, workers=args.layout_workers,
+                                          solver=args.layout_solver, sink=layout_records.append)
+    print(f"Foreground layout seed: {layout_seed}")
+    for record in layout_records:
+        print_sink(record)
     with open(os.path.join(args.output_dir, 'foreground_layout.json'), "w", encoding='utf-8') as f:
         json.dump(foreground_text, f, ensure_ascii=False, indent=4)
+    with open(os.path.join(args.output_dir, 'foreground_layout_stats.json'), "w", encoding='utf-8') as f:
+        json.dump({"seed": layout_seed, "entities": layout_records}, f, ensure_ascii=False, indent=4)
 
-    fore2back_layout = []
-    foreground_entities_name = []
-    for entity in foreground_text:
-        fore2back_layout.append(calcuate_background_box(entity['position']))
-        foreground_entities_name.append(entity['name'])
-    
-    fore2back_layout = process_boxes(fore2back_layout)
+    foreground_entities_name = [entity['name'] for entity in foreground_text]
+    projected = project_background_boxes([entity['position'] for entity in foreground_text],
+                                         json.loads(args.audience) if args.audience else None)
+    fore2back_layout = union_boxes(combine_viewpoints(projected).tolist())
+
+    backdrop = backdrop_occupancy(fore2back_layout)
+    backdrop_regions = free_regions(backdrop)
 
     prompt2reco = background_generator(
         imagery_descriptions, 
         foreground_entities_name,
         fore2back_layout,
-        client
+        client,
+        backdrop_regions
     )
     prompt2reco = extract_json(prompt2reco)
+    if prompt2reco:
+        # move boxes that overlap the foreground into free space instead of asking again
+        prompt2reco[0]['coordinates'] = snap_boxes(prompt2reco[0]['coordinates'], backdrop, backdrop_regions)
     with open(os.path.join(args.output_dir, 'prompt2reco.json'), "w", encoding='utf-8') as f:
         json.dump(prompt2reco, f, ensure_ascii=False, indent=4)
 
-    for entity in foreground_text:
-        candidates = object_retriever.retrieve(
-            [f"a 3D model of {extract_non_digit(entity['name'])}, {entity['description']}"],
-            threshold=27
-        )
-        entity['asset_id'] = random.choice(candidates[:10])[0] if candidates else ""
+    # one encoding and scoring pass for the whole stage
+    entity_sizes = None
+    if not args.no_size_rerank:
+        # prefer assets whose bounding box matches the placed footprint and height
+        entity_sizes = [[x_right - x_left, y_right - y_left, h_high - h_low]
+                        for x_left, y_left, x_right, y_right, h_low, h_high in
+                        (entity['position'] for entity in foreground_text)]
+    entity_candidates = object_retriever.retrieve_candidates(
+        [f"a 3D model of {extract_non_digit(entity['name'])}, {entity['description']}" for entity in foreground_text],
+        k=10,
+        threshold=27,
+        sizes=entity_sizes
+    )
+    for entity, candidates in zip(foreground_text, entity_candidates):
+        entity['asset_id'] = random.choice(candidates)[0] if candidates else ""
 
     with open(os.path.join(args.output_dir, 'final.json'), 'w', encoding='utf-8') as f:
         json.dump(foreground_text, f, indent=4, ensure_ascii=False)
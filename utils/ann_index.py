@@ -0,0 +1,114 @@
+"""
+Inverted-file (IVF) index over the CLIP view features, for approximate asset retrieval on CPU.
+
+    python -m utils.ann_index --features_dir ~/.objathor-assets/2023_09_23/features
+
+clusters every rendered view of every asset with spherical k-means and stores, for each
+cluster, the assets that have a view in it. A query only scores the assets listed under its
+nprobe closest centroids with the exact retrieve formula, so more probes trade latency for
+recall. The index is written as ivf_index.npz next to the feature files it was built from.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from utils.feature_store import has_feature_store, load_features, load_pickled_features
+
+IVF_INDEX_FILE = "ivf_index.npz"
+DEFAULT_NPROBE = 16
+
+
+def assign(vectors, centroids, chunk=65536):
+    """Index of the closest centroid, by inner product, of every row of vectors."""
+    assignment = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), chunk):
+        assignment[start:start + chunk] = np.argmax(vectors[start:start + chunk] @ centroids.T, axis=1)
+    return assignment
+
+
+def spherical_kmeans(vectors, n_lists, iterations=20, rng=None):
+    rng = rng or np.random.default_rng(0)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # an empty cluster restarts from a random vector instead of staying dead
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        norms[empty] = 1
+        centroids = sums / norms
+    return centroids
+
+
+class IVFIndex:
+    def __init__(self, centroids, offsets, assets):
+        self.centroids = centroids  # (n_lists, dim) unit vectors
+        self.offsets = offsets      # assets of list i are assets[offsets[i]:offsets[i + 1]]
+        self.assets = assets
+
+    @classmethod
+    def build(cls, clip_features, n_lists=None, iterations=20, train_size=200000, seed=0):
+        """clip_features: (assets, views, dim) normalized array, e.g. the feature store memmap."""
+        n_assets, n_views, dim = clip_features.shape
+        views = np.asarray(clip_features, dtype=np.float32).reshape(-1, dim)
+        n_lists = n_lists or max(1, int(4 * np.sqrt(len(views))))
+        rng = np.random.default_rng(seed)
+        train = views if len(views) <= train_size else views[rng.choice(len(views), train_size, replace=False)]
+        centroids = spherical_kmeans(train, min(n_lists, len(train)), iterations, rng)
+
+        lists = assign(views, centroids)
+        # one entry per (list, asset) pair, an asset with several views in a list appears once
+        pairs = np.unique(lists * n_assets + np.repeat(np.arange(n_assets), n_views))
+        offsets = np.searchsorted(pairs // n_assets, np.arange(len(centroids) + 1))
+        return cls(centroids.astype(np.float32), offsets.astype(np.int64), (pairs % n_assets).astype(np.int32))
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, assets=self.assets)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], data["offsets"], data["assets"])
+
+    def probe(self, queries, nprobe=DEFAULT_NPROBE):
+        """Candidate asset indices of every (normalized) query, one sorted array per query."""
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        nprobe = min(nprobe, len(self.centroids))
+        scores = queries @ self.centroids.T
+        probed = np.argpartition(-scores, nprobe - 1, axis=1)[:, :nprobe]
+        return [np.unique(np.concatenate([self.assets[self.offsets[i]:self.offsets[i + 1]] for i in lists]))
+                for lists in probed]
+
+
+def index_path(features_dir):
+    return os.path.join(features_dir, IVF_INDEX_FILE)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Build the IVF index of the asset CLIP features")
+    parser.add_argument("--features_dir", type=str, required=True, help="Directory of the asset features")
+    parser.add_argument("--n_lists", type=int, default=None, help="Number of clusters, 4 * sqrt(views) by default")
+    parser.add_argument("--iterations", type=int, default=20, help="k-means iterations")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if has_feature_store(args.features_dir):
+        _, clip_features, _ = load_features(args.features_dir)
+    else:
+        _, clip_features, _ = load_pickled_features(args.features_dir)
+    index = IVFIndex.build(clip_features, args.n_lists, args.iterations, seed=args.seed)
+    index.save(index_path(args.features_dir))
+    sizes = np.diff(index.offsets)
+    print(f"Wrote {len(index.centroids)} lists, {sizes.mean():.1f} assets per list on average, "
+          f"to {index_path(args.features_dir)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Indexed on-disk store of the Objathor annotations.
+
+    python -m utils.annotation_store --annotations ~/.objathor-assets/2023_09_23/annotations.json.gz
+
+parses annotations.json.gz once and writes annotations.sqlite next to it, one JSON record per
+uid under a primary key index. AnnotationStore opens it as a read-only mapping and decodes a
+record only when it is looked up, so the retriever no longer parses and copies the metadata
+of every asset at startup.
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+ANNOTATION_STORE_FILE = "annotations.sqlite"
+
+
+def store_path(annotations_path):
+    return os.path.join(os.path.dirname(annotations_path), ANNOTATION_STORE_FILE)
+
+
+def convert_annotations(annotations_path, output_path=None):
+    import compress_json
+
+    output_path = output_path or store_path(annotations_path)
+    annotations = compress_json.load(annotations_path)
+    temporary = f"{output_path}.tmp"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    connection = sqlite3.connect(temporary)
+    with connection:
+        connection.execute("CREATE TABLE annotations (uid TEXT PRIMARY KEY, record TEXT NOT NULL)")
+        connection.executemany("INSERT INTO annotations VALUES (?, ?)",
+                               ((uid, json.dumps(record)) for uid, record in annotations.items()))
+    connection.close()
+    os.replace(temporary, output_path)
+    return len(annotations)
+
+
+class AnnotationStore:
+    """Read-only dict-like view of annotations.sqlite, with the last max_cached records kept decoded."""
+
+    def __init__(self, path, max_cached=1024):
+        self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.max_cached = max_cached
+
+    def __getitem__(self, uid):
+        if uid in self.cache:
+            self.cache.move_to_end(uid)
+            return self.cache[uid]
+        with self.lock:
+            row = self.connection.execute("SELECT record FROM annotations WHERE uid = ?", (uid,)).fetchone()
+        if row is None:
+            raise KeyError(uid)
+        record = json.loads(row[0])
+        self.cache[uid] = record
+        if len(self.cache) > self.max_cached:
+            self.cache.popitem(last=False)
+        return record
+
+    def get(self, uid, default=None):
+        try:
+            return self[uid]
+        except KeyError:
+            return default
+
+    def __contains__(self, uid):
+        if uid in self.cache:
+            return True
+        with self.lock:
+            return self.connection.execute("SELECT 1 FROM annotations WHERE uid = ?", (uid,)).fetchone() is not None
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def keys(self):
+        with self.lock:
+            uids = [uid for uid, in self.connection.execute("SELECT uid FROM annotations")]
+        return iter(uids)
+
+    def __iter__(self):
+        return self.keys()
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert annotations.json.gz into an indexed SQLite store")
+    parser.add_argument("--annotations", type=str, required=True, help="Path of annotations.json.gz")
+    parser.add_argument("--output", type=str, default=None, help="Defaults to annotations.sqlite next to the annotations")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    count = convert_annotations(args.annotations, args.output)
+    print(f"Wrote {count} annotations to {args.output or store_path(args.annotations)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Category shards of the asset library.
+
+    python -m utils.asset_shards --features_dir ~/.objathor-assets/2023_09_23/features \
+        --annotations ~/.objathor-assets/2023_09_23/annotations.json.gz
+
+groups the assets by the category of their annotation, categories smaller than
+--min_shard_size sharing one misc shard, and stores each shard's members with the centroid of
+their view-pooled CLIP features as category_shards.npz next to the features. Each query is
+routed to its own closest shard centroids and only their assets are scored, unless its best
+shards do not stand out from the rest, in which case route gives None for that query and the
+caller scores it against everything.
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+from utils.ann_index import IVFIndex
+from utils.feature_store import has_feature_store, load_features, load_pickled_features, pooled_features
+
+SHARD_INDEX_FILE = "category_shards.npz"
+MIN_SHARD_SIZE = 20
+DEFAULT_SHARDS = 3
+DEFAULT_ROUTER_MARGIN = 0.02
+MISC_SHARD = "misc"
+
+
+def asset_categories(database, uids):
+    return [str(database.get(uid, {}).get("category") or MISC_SHARD).lower() for uid in uids]
+
+
+class CategoryShards(IVFIndex):
+    """An IVFIndex with one list per category shard, each asset in exactly one list."""
+
+    def __init__(self, centroids, offsets, assets, names):
+        super().__init__(centroids, offsets, assets)
+        self.names = names
+
+    @classmethod
+    def build(cls, clip_features, categories, min_shard_size=MIN_SHARD_SIZE):
+        names, counts = np.unique(categories, return_counts=True)
+        small = set(names[counts < min_shard_size])
+        names, labels = np.unique([MISC_SHARD if category in small else category for category in categories],
+                                  return_inverse=True)
+
+        pooled = pooled_features(clip_features)
+        sums = np.zeros((len(names), pooled.shape[1]), dtype=np.float32)
+        np.add.at(sums, labels, pooled)
+        centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        assets = np.argsort(labels, kind="stable").astype(np.int32)
+        offsets = np.searchsorted(labels[assets], np.arange(len(names) + 1)).astype(np.int64)
+        return cls(centroids, offsets, assets, [str(name) for name in names])
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, assets=self.assets, names=np.array(self.names))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["centroids"], data["offsets"], data["assets"], [str(name) for name in data["names"]])
+
+    def route(self, queries, n_shards=DEFAULT_SHARDS, margin=DEFAULT_ROUTER_MARGIN):
+        """
+        One entry per query: the sorted asset indices of its n_shards closest shards, or None when
+        its best shard beats the first shard left out by less than margin (cosine).
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.centroids.shape[1])
+        if n_shards >= len(self.centroids):
+            return [None] * len(queries)
+        scores = np.sort(queries @ self.centroids.T, axis=1)[:, ::-1]
+        confident = scores[:, 0] - scores[:, n_shards] >= margin
+        return [candidates if routed else None
+                for candidates, routed in zip(self.probe(queries, n_shards), confident)]
+
+
+def shards_path(features_dir):
+    return os.path.join(features_dir, SHARD_INDEX_FILE)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Partition the asset library into category shards")
+    parser.add_argument("--features_dir", type=str, required=True, help="Directory of the asset features")
+    parser.add_argument("--annotations", type=str, required=True, help="annotations.json.gz with the asset categories")
+    parser.add_argument("--min_shard_size", type=int, default=MIN_SHARD_SIZE, help="Smaller categories go to the misc shard")
+    return parser.parse_args()
+
+
+def main():
+    import compress_json
+
+    args = parse_arguments()
+    if has_feature_store(args.features_dir):
+        uids, clip_features, _ = load_features(args.features_dir)
+    else:
+        uids, clip_features, _ = load_pickled_features(args.features_dir)
+    categories = asset_categories(compress_json.load(args.annotations), uids)
+    shards = CategoryShards.build(clip_features, categories, args.min_shard_size)
+    shards.save(shards_path(args.features_dir))
+    sizes = np.diff(shards.offsets)
+    print(f"Wrote {len(shards.names)} shards, largest {sizes.max()} assets, to {shards_path(args.features_dir)}")
+
+
+if __name__ == "__main__":
+    main()
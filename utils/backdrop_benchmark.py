@@ -0,0 +1,103 @@
+"""
+Backdrop box merging benchmark on synthetic scenes.
+
+    python -m utils.backdrop_benchmark --anchors 20 --ornaments 300 --repeats 3 --output backdrop.json
+
+Each scene is laid out with utils.placement_rules.layout, every placed entity is projected with
+calcuate_background_box and the projected boxes are merged by process_boxes and union_boxes.
+With --source random the boxes are instead drawn uniformly on a 10 cm grid, which keeps them
+from collapsing into a few containing boxes. Results report the time and the number of boxes
+of both, and whether they cover the same area.
+"""
+
+import argparse
+import contextlib
+import json
+import random
+import sys
+import time
+
+import numpy as np
+
+from utils.background_projection import calcuate_background_box, process_boxes, union_boxes
+from utils.placement_benchmark import git_commit, synthetic_scene
+from utils.placement_rules import layout
+
+
+def projected_boxes(n_anchors, n_ornaments, seed):
+    anchor_text, ornament_text = synthetic_scene(n_anchors, n_ornaments, seed=seed)
+    placements, _ = layout(anchor_text, ornament_text, seed=seed, sink=lambda record: None)
+    return [calcuate_background_box(placement['position']) for placement in placements]
+
+
+def random_boxes(n_boxes, seed, size_range=(10, 80), size=1000):
+    rng = random.Random(seed)
+    boxes = []
+    for _ in range(n_boxes):
+        x, y = rng.randrange(0, size - size_range[0], 10), rng.randrange(0, size - size_range[0], 10)
+        boxes.append([x, y, x + rng.randrange(*size_range, 10), y + rng.randrange(*size_range, 10)])
+    return boxes
+
+
+def coverage(boxes, size=1000):
+    grid = np.zeros((size, size), dtype=bool)
+    for x_left, y_top, x_right, y_bottom in boxes:
+        grid[max(0, y_top):y_bottom, max(0, x_left):x_right] = True
+    return grid
+
+
+def time_merge(merge, boxes):
+    start = time.perf_counter()
+    merged = merge([list(box) for box in boxes])
+    return time.perf_counter() - start, merged
+
+
+def benchmark(n_anchors=20, n_ornaments=300, repeats=3, seed=0, reference=True, source='layout'):
+    scenes = []
+    for repeat in range(repeats):
+        if source == 'layout':
+            boxes = projected_boxes(n_anchors, n_ornaments, seed + repeat)
+        else:
+            boxes = random_boxes(n_anchors + n_ornaments, seed + repeat)
+        scene = {"boxes": len(boxes)}
+        union_seconds, union = time_merge(union_boxes, boxes)
+        scene["union_boxes"] = {"seconds": union_seconds, "output_boxes": len(union)}
+        if reference:
+            process_seconds, processed = time_merge(process_boxes, boxes)
+            scene["process_boxes"] = {"seconds": process_seconds, "output_boxes": len(processed)}
+            scene["same_coverage"] = bool((coverage(union) == coverage(processed)).all())
+        scenes.append(scene)
+
+    return {
+        "commit": git_commit(),
+        "config": {"anchors": n_anchors, "ornaments": n_ornaments, "repeats": repeats, "seed": seed, "source": source},
+        "scenes": scenes
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark backdrop box merging on synthetic scenes')
+    parser.add_argument('--anchors', type=int, default=20, help='Number of anchors per scene')
+    parser.add_argument('--ornaments', type=int, default=300, help='Number of ornaments per scene')
+    parser.add_argument('--repeats', type=int, default=3, help='Number of scenes, each with its own seed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--source', type=str, default='layout', choices=['layout', 'random'],
+                        help='Project laid out synthetic scenes or draw anchors + ornaments random boxes')
+    parser.add_argument('--no_reference', action='store_true', help='Skip process_boxes, e.g. on very large scenes')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results here instead of stdout')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    with contextlib.redirect_stdout(sys.stderr):
+        results = benchmark(args.anchors, args.ornaments, args.repeats, args.seed, not args.no_reference, args.source)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
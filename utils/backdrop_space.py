@@ -0,0 +1,114 @@
+"""
+Free space of the stage backdrop.
+
+The merged foreground boxes of background_projection are rasterized into an OccupancyMap of
+the backdrop canvas. free_regions finds large empty rectangles to offer the LLM in the
+background prompt, and snap_boxes moves the boxes it returns out of the foreground locally,
+so a box that overlaps a foreground entity does not need another LLM round trip.
+Boxes are [x1, y1, x2, y2] in cm with y increasing downward, as in background_generator.
+"""
+
+import numpy as np
+
+from utils.occupancy import OccupancyMap
+
+BACKDROP_SIZE = 1000
+FREE_REGION_CELL = 10
+MAX_FREE_REGIONS = 8
+MIN_FREE_REGION = 50
+
+
+def backdrop_occupancy(boxes, size=BACKDROP_SIZE):
+    backdrop = OccupancyMap(size, size)
+    for x1, y1, x2, y2 in boxes:
+        backdrop.fill(int(x1), int(y1), int(x2) - int(x1), int(y2) - int(y1))
+    return backdrop
+
+
+def cell_occupancy(backdrop, cell=FREE_REGION_CELL):
+    """Coarse bool grid, a cell is occupied if any backdrop cm inside it is. Also returns the cell edges."""
+    height, width = backdrop.shape
+    rows = np.append(np.arange(0, height, cell), height)
+    cols = np.append(np.arange(0, width, cell), width)
+    s = backdrop.integral[np.ix_(rows, cols)]
+    counts = s[1:, 1:] - s[:-1, 1:] - s[1:, :-1] + s[:-1, :-1]
+    return counts > 0, rows, cols
+
+
+def largest_empty_rectangle(occupied):
+    """(r0, c0, r1, c1) of the largest all-False rectangle of a bool grid, by row histograms. None if there is none."""
+    best, best_area = None, 0
+    heights = np.zeros(occupied.shape[1], dtype=np.intp)
+    for r in range(occupied.shape[0]):
+        heights = np.where(occupied[r], 0, heights + 1)
+        stack = []  # column indices with increasing heights
+        for c in range(occupied.shape[1] + 1):
+            height = heights[c] if c < occupied.shape[1] else 0
+            start = c
+            while stack and heights[stack[-1]] >= height:
+                top = stack.pop()
+                start = stack[-1] + 1 if stack else 0
+                area = heights[top] * (c - start)
+                if area > best_area:
+                    best, best_area = (r + 1 - heights[top], start, r + 1, c), area
+            stack.append(c)
+    return best
+
+
+def free_regions(backdrop, cell=FREE_REGION_CELL, max_regions=MAX_FREE_REGIONS, min_size=MIN_FREE_REGION):
+    """
+    Up to max_regions disjoint empty boxes, largest first, each at least min_size cm on both
+    sides. Regions are found on a cell-sized grid, so they are exact multiples of cell apart
+    from the canvas border.
+    """
+    occupied, rows, cols = cell_occupancy(backdrop, cell)
+    occupied = occupied.copy()
+    regions = []
+    while len(regions) < max_regions:
+        rectangle = largest_empty_rectangle(occupied)
+        if rectangle is None:
+            break
+        r0, c0, r1, c1 = rectangle
+        box = [int(cols[c0]), int(rows[r0]), int(cols[c1]), int(rows[r1])]
+        if box[2] - box[0] < min_size or box[3] - box[1] < min_size:
+            break
+        regions.append(box)
+        occupied[r0:r1, c0:c1] = True
+    return regions
+
+
+def overlap(box1, box2):
+    return max(0, min(box1[2], box2[2]) - max(box1[0], box2[0])) * max(0, min(box1[3], box2[3]) - max(box1[1], box2[1]))
+
+
+def snap_box(box, backdrop, regions):
+    """
+    Returns box unchanged if it is free, else the nearest free box of the same size, else the
+    box shrunk into the free region it overlaps most. A box with no free space left is kept.
+    """
+    height, width = backdrop.shape
+    x1, y1 = min(max(int(box[0]), 0), width - 1), min(max(int(box[1]), 0), height - 1)
+    w, h = max(1, min(int(box[2]), width) - x1), max(1, min(int(box[3]), height) - y1)
+    if backdrop.is_free(x1, y1, w, h):
+        return [x1, y1, x1 + w, y1 + h]
+
+    xs, ys = backdrop.free_positions(0, width, 0, height, w, h)
+    if len(xs):
+        nearest = np.argmin((xs - x1) ** 2 + (ys - y1) ** 2)
+        return [int(xs[nearest]), int(ys[nearest]), int(xs[nearest]) + w, int(ys[nearest]) + h]
+
+    if not regions:
+        return list(box)
+    center = np.array([x1 + w / 2, y1 + h / 2])
+    region = max(regions, key=lambda r: (overlap(r, [x1, y1, x1 + w, y1 + h]),
+                                         -np.hypot(*(center - [(r[0] + r[2]) / 2, (r[1] + r[3]) / 2]))))
+    w, h = min(w, region[2] - region[0]), min(h, region[3] - region[1])
+    x1 = min(max(x1, region[0]), region[2] - w)
+    y1 = min(max(y1, region[1]), region[3] - h)
+    return [x1, y1, x1 + w, y1 + h]
+
+
+def snap_boxes(boxes, backdrop, regions=None):
+    if regions is None:
+        regions = free_regions(backdrop)
+    return [snap_box(box, backdrop, regions) for box in boxes]
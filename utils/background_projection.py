@@ -22,6 +22,47 @@ def calcuate_background_box(object, background = [[0,0],[999,999],[0,999]], stag
     h_high = stage[2] - object[5] #transform into the background y coordinate
     return [left_proj,h_high,right_proj,h_low]
 
+AUDIENCE_OFFSET = 200
+
+def corner_viewpoints(stage = [999,999,999]):
+    """The two viewers of calcuate_background_box, at both stage corners AUDIENCE_OFFSET cm in front of the stage."""
+    return np.array([[stage[0], stage[1] + AUDIENCE_OFFSET], [0, stage[1] + AUDIENCE_OFFSET]], dtype=np.float64)
+
+def project_background_boxes(positions, viewpoints = None, background = [[0,0],[999,999],[0,999]], stage = [999,999,999], union = False):
+    """
+    positions: (N, 6) array of [x_left, y_left, x_right, y_right, h_low, h_high] boxes, viewpoints: (V, 2)
+    array of audience (x, y) floor positions, the corner viewers by default.
+    Returns a (V, N, 4) int array, the backdrop box every viewer sees behind every entity, in the
+    calcuate_background_box format. The sightlines through the four footprint corners are extended
+    to the backdrop at y = 0 and the box spans the outermost ones. With union=True returns instead
+    one union_boxes list per viewpoint.
+    """
+    positions = np.asarray(positions, dtype=np.float64).reshape(-1, 6)
+    viewpoints = corner_viewpoints(stage) if viewpoints is None else np.asarray(viewpoints, dtype=np.float64).reshape(-1, 2)
+    corner_x = positions[:, [0, 0, 2, 2]]
+    corner_y = positions[:, [1, 3, 1, 3]]
+    view_x = viewpoints[:, 0, None, None]
+    view_y = viewpoints[:, 1, None, None]
+    # a viewer on or behind a corner would divide by zero or flip the sightline
+    depth = np.maximum(view_y - corner_y, 1e-6)
+    projected = (corner_x * view_y - view_x * corner_y) / depth
+
+    boxes = np.empty((len(viewpoints), len(positions), 4), dtype=np.int64)
+    boxes[..., 0] = np.floor(np.maximum(background[0][0], projected.min(axis=2)))
+    boxes[..., 2] = np.ceil(np.minimum(background[1][0], projected.max(axis=2)))
+    boxes[..., 1] = stage[2] - positions[:, 5]
+    boxes[..., 3] = stage[2] - positions[:, 4]
+    if union:
+        return [union_boxes(view_boxes.tolist()) for view_boxes in boxes]
+    return boxes
+
+def combine_viewpoints(boxes):
+    """(V, N, 4) projected boxes -> (N, 4) boxes spanning what any viewer sees behind each entity."""
+    combined = boxes[0].copy()
+    combined[:, :2] = boxes[..., :2].min(axis=0)
+    combined[:, 2:] = boxes[..., 2:].max(axis=0)
+    return combined
+
 def is_contained(box1, box2):
     return (
         box1[0] >= box2[0] and box1[1] >= box2[1] and
@@ -97,6 +138,144 @@ def process_boxes(boxes):
         
     return boxes
 
+class CoverageTree:
+    """Segment tree over the elementary intervals between sorted coords, counting the boxes covering each."""
+
+    def __init__(self, coords):
+        self.coords = coords
+        self.n = len(coords) - 1
+        self.count = [0] * (4 * self.n)
+        self.full = [False] * (4 * self.n)  # the whole node interval is covered
+        self.any = [False] * (4 * self.n)   # some of the node interval is covered
+
+    def add(self, low, high, delta, node=1, left=0, right=None):
+        """Adds delta to the count of elementary intervals low..high-1."""
+        if right is None:
+            right = self.n
+        if high <= left or right <= low:
+            return
+        if low <= left and right <= high:
+            self.count[node] += delta
+        else:
+            middle = (left + right) // 2
+            self.add(low, high, delta, 2 * node, left, middle)
+            self.add(low, high, delta, 2 * node + 1, middle, right)
+        if self.count[node] > 0:
+            self.full[node] = self.any[node] = True
+        elif right - left == 1:
+            self.full[node] = self.any[node] = False
+        else:
+            self.full[node] = self.full[2 * node] and self.full[2 * node + 1]
+            self.any[node] = self.any[2 * node] or self.any[2 * node + 1]
+
+    def first_uncovered(self, start):
+        """Smallest elementary interval index >= start that no box covers, n if there is none."""
+        def find(node, left, right):
+            if right <= start or self.full[node]:
+                return None
+            if not self.any[node]:
+                return max(left, start)
+            middle = (left + right) // 2
+            found = find(2 * node, left, middle)
+            return found if found is not None else find(2 * node + 1, middle, right)
+
+        found = find(1, 0, self.n) if self.n > 0 else None
+        return self.n if found is None else found
+
+    def last_uncovered(self, end):
+        """Largest elementary interval index < end that no box covers, -1 if there is none."""
+        def find(node, left, right):
+            if end <= left or self.full[node]:
+                return None
+            if not self.any[node]:
+                return min(right, end) - 1
+            middle = (left + right) // 2
+            found = find(2 * node + 1, middle, right)
+            return found if found is not None else find(2 * node, left, middle)
+
+        found = find(1, 0, self.n) if self.n > 0 else None
+        return -1 if found is None else found
+
+    def runs(self, low=0, high=None):
+        """Maximal covered intervals within elementary intervals low..high-1 as (low, high) coordinate pairs, in order."""
+        high = self.n if high is None else high
+        runs = []
+        stack = [(1, 0, self.n)] if self.n > 0 else []
+        while stack:
+            node, left, right = stack.pop()
+            if right <= low or high <= left or not self.any[node]:
+                continue
+            if self.full[node]:
+                start, end = self.coords[max(left, low)], self.coords[min(right, high)]
+                if runs and runs[-1][1] == start:
+                    runs[-1] = (runs[-1][0], end)
+                else:
+                    runs.append((start, end))
+                continue
+            middle = (left + right) // 2
+            stack.append((2 * node + 1, middle, right))
+            stack.append((2 * node, left, middle))
+        return runs
+
+    def runs_touching(self, ranges):
+        """The maximal covered runs that overlap or touch any of the elementary interval ranges (low, high)."""
+        extended = sorted((self.last_uncovered(low) + 1, self.first_uncovered(high)) for low, high in ranges)
+        merged = []
+        for low, high in extended:
+            if merged and low <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], high)
+            else:
+                merged.append([low, high])
+        return {run for low, high in merged for run in self.runs(low, high)}
+
+def sweep_union(boxes):
+    """
+    Union of [x_left, y_top, x_right, y_bottom] boxes as horizontal strips, sweeping along x.
+    A strip is a maximal covered y-run that stays unchanged over an x-range. Strips do not overlap.
+    Only the runs touching the y-ranges of the boxes starting or ending at a sweep stop are
+    compared, so the sweep takes O((n + k) log n) for n boxes and k strips.
+    """
+    boxes = [box for box in boxes if box[0] < box[2] and box[1] < box[3]]
+    if not boxes:
+        return []
+    ys = sorted({box[1] for box in boxes} | {box[3] for box in boxes})
+    y_index = {y: i for i, y in enumerate(ys)}
+    events = []
+    for box in boxes:
+        events.append((box[0], 1, y_index[box[1]], y_index[box[3]]))
+        events.append((box[2], -1, y_index[box[1]], y_index[box[3]]))
+    events.sort()
+
+    tree = CoverageTree(ys)
+    open_runs = {}  # (y_top, y_bottom) -> x where the strip started
+    result = []
+    i = 0
+    while i < len(events):
+        x = events[i][0]
+        stop = i
+        while i < len(events) and events[i][0] == x:
+            i += 1
+        ranges = [(low, high) for _, _, low, high in events[stop:i]]
+        before = tree.runs_touching(ranges)
+        for _, delta, low, high in events[stop:i]:
+            tree.add(low, high, delta)
+        after = tree.runs_touching(ranges)
+        for run in before - after:
+            result.append([open_runs.pop(run), run[0], x, run[1]])
+        for run in after - before:
+            open_runs[run] = x
+    return result
+
+def union_boxes(boxes):
+    """
+    Replacement for process_boxes: non-overlapping boxes covering exactly the union of the input.
+    Both sweep directions are tried and the one giving fewer boxes is kept, so L-shapes and
+    crosses come out as two or three boxes. This is not a minimum partition in general.
+    """
+    by_x = sweep_union(boxes)
+    by_y = [[box[1], box[0], box[3], box[2]] for box in sweep_union([[b[1], b[0], b[3], b[2]] for b in boxes])]
+    return sorted(by_x if len(by_x) <= len(by_y) else by_y, key=lambda box: (box[1], box[0]))
+
 def visualization(objects,number):
     import matplotlib.pyplot as plt
     import matplotlib.patches as patches
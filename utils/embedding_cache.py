@@ -0,0 +1,132 @@
+"""
+Content-addressed cache of text embeddings, keyed by (model id, text).
+
+Stages repeat the same query phrasing, so ObjathorRetriever looks every query up here before
+running the text encoders. Hits come from an in-memory LRU, then from one .npy file per key
+on disk. The disk tier is trimmed by least recent use once it grows past max_disk_bytes. A
+file's mtime records its last use, memory hits included, refreshed at most every TOUCH_INTERVAL
+seconds per key.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "EMBEDDING_CACHE_DIR", os.path.expanduser("~/.cache/stagedesigner/embeddings")
+)
+TOUCH_INTERVAL = 60
+
+
+class EmbeddingCache:
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, max_memory_items=4096, max_disk_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.touched = {}  # key -> time.monotonic() of the last mtime refresh, for the keys in memory
+        self.disk_bytes = None  # summed on the first write
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(model_id, text):
+        return hashlib.sha256(f"{model_id}\0{text}".encode("utf-8")).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def remember(self, key, vector):
+        self.memory[key] = vector
+        self.memory.move_to_end(key)
+        self.touched[key] = time.monotonic()
+        while len(self.memory) > self.max_memory_items:
+            evicted, _ = self.memory.popitem(last=False)
+            self.touched.pop(evicted, None)
+
+    def touch(self, key):
+        """Marks the file of key as just used, so evict orders it by real use."""
+        self.touched[key] = time.monotonic()
+        try:
+            os.utime(self.path(key))
+        except OSError:
+            pass  # evicted by another process, the vector in memory is still good
+
+    def get(self, model_id, text):
+        key = self.key(model_id, text)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            if self.cache_dir is not None and time.monotonic() - self.touched.get(key, 0) > TOUCH_INTERVAL:
+                self.touch(key)
+            return self.memory[key]
+        if self.cache_dir is None:
+            return None
+        try:
+            vector = np.load(self.path(key))
+        except (OSError, ValueError):
+            return None
+        self.touch(key)
+        self.remember(key, vector)
+        return vector
+
+    def put(self, model_id, text, vector):
+        key = self.key(model_id, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self.remember(key, vector)
+        if self.cache_dir is None:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, so concurrent readers never see half a file
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as f:
+            np.save(f, vector)
+        os.replace(temporary, path)
+        if self.disk_bytes is None:
+            self.disk_bytes = sum(size for _, size, _ in self.disk_entries())
+        else:
+            self.disk_bytes += os.path.getsize(path)
+        if self.disk_bytes > self.max_disk_bytes:
+            self.evict()
+
+    def disk_entries(self):
+        for directory, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".npy"):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat.st_size, stat.st_mtime
+
+    def evict(self):
+        """Deletes the least recently used files until the disk tier is back under 90% of its limit."""
+        entries = sorted(self.disk_entries(), key=lambda entry: entry[2])
+        self.disk_bytes = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self.disk_bytes <= 0.9 * self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.disk_bytes -= size
+
+    def encode(self, model_id, texts, encoder):
+        """
+        (len(texts), dim) float32 embeddings of texts. encoder is only called once, with the
+        texts that were not cached, and must return their embeddings in order.
+        """
+        vectors = [self.get(model_id, text) for text in texts]
+        missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            encoded = dict(zip(missing, np.asarray(encoder(missing), dtype=np.float32)))
+            for text, vector in encoded.items():
+                self.put(model_id, text, vector)
+            vectors = [encoded[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+        return np.stack(vectors)
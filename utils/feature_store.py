@@ -0,0 +1,131 @@
+"""
+Memory-mapped asset features for ObjathorRetriever.
+
+    python -m utils.feature_store --features_dir ~/.objathor-assets/2023_09_23/features --float16
+
+converts clip_features.pkl and sbert_features.pkl once into clip_features.npy, L2-normalized
+over the last axis, sbert_features.npy and uids.json in the same directory. With --annotations
+it also writes bbox_sizes.npy, the sorted bounding box dimensions of every asset in cm.
+clip_pooled.npy holds one normalized mean-of-views CLIP vector per asset for prefiltering.
+load_features opens them with np.load(mmap_mode='r'): nothing is decompressed or copied at
+startup and the pages are shared between processes through the OS page cache.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+CLIP_FEATURES_FILE = "clip_features.npy"
+SBERT_FEATURES_FILE = "sbert_features.npy"
+UIDS_FILE = "uids.json"
+SIZES_FILE = "bbox_sizes.npy"
+POOLED_FILE = "clip_pooled.npy"
+
+
+def has_feature_store(features_dir):
+    return all(os.path.exists(os.path.join(features_dir, name))
+               for name in (CLIP_FEATURES_FILE, SBERT_FEATURES_FILE, UIDS_FILE))
+
+
+def normalize(features, chunk=4096):
+    """L2-normalized float32 copy over the last axis, computed a chunk of assets at a time."""
+    normalized = np.empty(features.shape, dtype=np.float32)
+    for start in range(0, len(features), chunk):
+        block = features[start:start + chunk].astype(np.float32)
+        norms = np.linalg.norm(block, axis=-1, keepdims=True)
+        normalized[start:start + chunk] = block / np.maximum(norms, 1e-12)
+    return normalized
+
+
+def pooled_features(clip_features, chunk=4096):
+    """(assets, dim) mean of the normalized views of every asset, normalized again."""
+    pooled = np.empty((len(clip_features), clip_features.shape[2]), dtype=np.float32)
+    for start in range(0, len(clip_features), chunk):
+        block = np.asarray(clip_features[start:start + chunk], dtype=np.float32).mean(axis=1)
+        pooled[start:start + chunk] = block / np.maximum(np.linalg.norm(block, axis=1, keepdims=True), 1e-12)
+    return pooled
+
+
+def load_pickled_features(features_dir):
+    """(uids, clip, sbert) from the compress_pickle files shipped with the assets, clip normalized."""
+    import compress_pickle
+
+    clip_features_dict = compress_pickle.load(os.path.join(features_dir, "clip_features.pkl"))
+    sbert_features_dict = compress_pickle.load(os.path.join(features_dir, "sbert_features.pkl"))
+    assert clip_features_dict["uids"] == sbert_features_dict["uids"]
+    return (list(clip_features_dict["uids"]), normalize(clip_features_dict["img_features"]),
+            sbert_features_dict["text_features"].astype(np.float32))
+
+
+def bbox_sizes(database, uids):
+    """(assets, 3) float32 array of the sorted bounding box dimensions in cm, NaN when an asset has none."""
+    from retrieve_obj import get_bbox_dims
+
+    sizes = np.full((len(uids), 3), np.nan, dtype=np.float32)
+    for i, uid in enumerate(uids):
+        try:
+            size = get_bbox_dims(database[uid])
+        except (KeyError, ValueError):
+            continue
+        sizes[i] = sorted([size["x"] * 100, size["y"] * 100, size["z"] * 100])
+    return sizes
+
+
+def convert_features(features_dir, output_dir=None, float16=False, annotations_path=None):
+    output_dir = output_dir or features_dir
+    os.makedirs(output_dir, exist_ok=True)
+    uids, clip_features, sbert_features = load_pickled_features(features_dir)
+    dtype = np.float16 if float16 else np.float32
+    np.save(os.path.join(output_dir, CLIP_FEATURES_FILE), clip_features.astype(dtype, copy=False))
+    np.save(os.path.join(output_dir, SBERT_FEATURES_FILE), sbert_features.astype(dtype, copy=False))
+    np.save(os.path.join(output_dir, POOLED_FILE), pooled_features(clip_features).astype(dtype, copy=False))
+    with open(os.path.join(output_dir, UIDS_FILE), "w", encoding="utf-8") as f:
+        json.dump(uids, f)
+    if annotations_path:
+        import compress_json
+
+        np.save(os.path.join(output_dir, SIZES_FILE), bbox_sizes(compress_json.load(annotations_path), uids))
+    return len(uids)
+
+
+def load_features(features_dir):
+    """(uids, clip, sbert) with clip (assets, views, dim) and sbert (assets, dim) as read-only memmaps."""
+    with open(os.path.join(features_dir, UIDS_FILE), encoding="utf-8") as f:
+        uids = json.load(f)
+    clip_features = np.load(os.path.join(features_dir, CLIP_FEATURES_FILE), mmap_mode="r")
+    sbert_features = np.load(os.path.join(features_dir, SBERT_FEATURES_FILE), mmap_mode="r")
+    assert len(uids) == len(clip_features) == len(sbert_features)
+    return uids, clip_features, sbert_features
+
+
+def load_sizes(features_dir):
+    """The bbox_sizes.npy memmap, None if it was not written."""
+    path = os.path.join(features_dir, SIZES_FILE)
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+
+def load_pooled(features_dir):
+    """The clip_pooled.npy memmap, None if it was not written."""
+    path = os.path.join(features_dir, POOLED_FILE)
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else None
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Convert the pickled asset features into memory-mappable .npy files")
+    parser.add_argument("--features_dir", type=str, required=True, help="Directory of clip_features.pkl and sbert_features.pkl")
+    parser.add_argument("--output_dir", type=str, default=None, help="Defaults to features_dir, where the retriever looks")
+    parser.add_argument("--annotations", type=str, default=None, help="annotations.json.gz, to also write bbox_sizes.npy")
+    parser.add_argument("--float16", action="store_true", help="Store the features as float16, half the size")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    count = convert_features(args.features_dir, args.output_dir, args.float16, args.annotations)
+    print(f"Wrote {count} assets to {args.output_dir or args.features_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""
+Incremental re-layout for interactive editing.
+
+    session = LayoutSession(anchor_text, ornament_text, seed=0)
+    placements = session.placements
+    placements = session.update(anchor_text, edited_ornament_text)
+
+The session keeps the floor map, every anchor's surface maps and the placed rectangles.
+Before each entity is placed it takes a copy-on-write snapshot of that state and it records
+the map fills of the entity. An update rolls back to the snapshot before the first changed
+entity, replays the recorded fills of the unchanged ones and only searches positions for the
+changed entities and the ornaments of changed anchors. Unchanged entities keep their exact
+rectangles, so their entries in foreground_layout.json do not move.
+"""
+
+import json
+import random
+
+from utils.placement_rules import (
+    STAGE_SIZE,
+    initialize_floor_map,
+    parse_anchor_prompt_data,
+    parse_ornament_prompt_data,
+    placement_record,
+    print_sink,
+    timed_place,
+    update_collision_map,
+)
+from utils.scene_graph import SceneGraph
+
+
+def signature(data):
+    return json.dumps({k: v for k, v in data.items() if k != 'rule'}, sort_keys=True, ensure_ascii=False)
+
+
+def load(text):
+    return json.loads(text) if isinstance(text, str) else text
+
+
+class LayoutSession:
+    def __init__(self, anchor_text, ornament_text, seed=0, exhaustive=False, stage_size=STAGE_SIZE, resolution=1,
+                 sink=print_sink):
+        self.seed = seed
+        self.exhaustive = exhaustive
+        self.stage_size = stage_size
+        self.resolution = resolution
+        self.sink = sink  # gets a placement_record for every entity that is searched again
+
+        self.anchor_signatures = None
+        self.anchor_entities = []
+        self.floor = None
+        self.graph = None
+        self.signatures = {}   # entity key -> signature of the entity
+        self.results = {}      # entity key -> Rectangle or None
+        self.fills = {}        # entity key -> [(target, x, y, h, w)], target is 'floor' or a surface name
+        self.order = []        # entity keys in the order their fills were applied
+        self.snapshots = []    # snapshots[i] is the state before order[i] was applied
+        self.index = {}        # entity key -> position in the current graph
+        self.placements = self.update(anchor_text, ornament_text)
+
+    def entity_rng(self, key):
+        # one stream per entity, so re-placing it does not depend on what else changed
+        return random.Random(f"{self.seed}:{key}")
+
+    def snapshot(self, touched=None):
+        """
+        Copy of the floor and the surface maps. With touched, the index of the only anchor whose
+        surfaces changed since the previous snapshot (-1 for none), the other surface copies are
+        shared with the previous snapshot instead of copied again.
+        """
+        if touched is None or not self.snapshots:
+            anchors = range(len(self.anchor_entities))
+            surfaces = {}
+        else:
+            anchors = [touched] if touched >= 0 else []
+            surfaces = dict(self.snapshots[-1][1])
+        for i in anchors:
+            for surface, surface_map in self.anchor_entities[i].surface_collision_maps.items():
+                if surface_map is not None:
+                    surfaces[i, surface] = surface_map.copy()
+        return self.floor.copy(), surfaces
+
+    def restore(self, snapshot):
+        floor, surfaces = snapshot
+        self.floor = floor.copy()
+        for anchor in self.anchor_entities:
+            for surface in anchor.surface_collision_maps:
+                anchor.surface_collision_maps[surface] = None
+        for (i, surface), surface_map in surfaces.items():
+            self.anchor_entities[i].surface_collision_maps[surface] = surface_map.copy()
+
+    def anchor_of(self, key):
+        anchor = self.graph.entity_anchor[self.index[key]]
+        return self.anchor_entities[anchor] if anchor >= 0 else None
+
+    def replay(self, key):
+        anchor = self.anchor_of(key)
+        for target, x, y, h, w in self.fills[key]:
+            collision_map = self.floor if target == 'floor' else anchor.get_surface_map(target)
+            update_collision_map(collision_map, x, y, h, w)
+
+    def place(self, key):
+        anchor = self.anchor_of(key)
+        entity = self.graph.entities[self.index[key]]
+        stats = {}
+        rectangle = timed_place(entity, anchor, self.floor, self.exhaustive, self.entity_rng(key), stats)
+        fills = []
+        for collision_map, x, y, h, w in stats.get('fills', []):
+            if collision_map is self.floor:
+                fills.append(('floor', x, y, h, w))
+            else:
+                surface = next(name for name, m in anchor.surface_collision_maps.items() if m is collision_map)
+                fills.append((surface, x, y, h, w))
+        self.fills[key] = fills
+        self.results[key] = rectangle
+        self.sink(placement_record(entity, anchor, rectangle, stats))
+
+    def update(self, anchor_text, ornament_text):
+        """Re-places what changed since the last call and returns the full placement list."""
+        anchor_groups = load(anchor_text)
+        ornaments = load(ornament_text)
+        anchor_signatures = [signature(group["anchor_entity"]) for group in anchor_groups]
+        floor = initialize_floor_map(self.stage_size, self.resolution)
+        anchor_entities, non_anchor_entities = parse_anchor_prompt_data(json.dumps(anchor_groups), floor)
+        non_anchor_entities = parse_ornament_prompt_data(json.dumps(ornaments), non_anchor_entities)
+        graph = SceneGraph(anchor_entities, non_anchor_entities)
+
+        keys, seen = [], {}
+        for entity in non_anchor_entities:
+            seen[entity['name']] = seen.get(entity['name'], 0) + 1
+            keys.append(entity['name'] if seen[entity['name']] == 1 else f"{entity['name']}#{seen[entity['name']]}")
+        signatures = {key: signature(entity) for key, entity in zip(keys, non_anchor_entities)}
+
+        # an entity is searched again when it changed or its anchor did, found through the anchor's children
+        dirty = {key for key in keys if self.signatures.get(key) != signatures[key]}
+        previous_anchors = set(self.anchor_signatures or ())
+        for anchor, anchor_signature in enumerate(anchor_signatures):
+            if anchor_signature not in previous_anchors:
+                dirty.update(keys[i] for i in graph.children[anchor])
+        dirty = [key for key in keys if key in dirty]
+        removed = set(self.signatures) - set(signatures)
+        stale = set(dirty) | removed
+
+        self.graph = graph
+        self.index = {key: i for i, key in enumerate(keys)}
+        if anchor_signatures != self.anchor_signatures:
+            # anchors own the surfaces and fill the floor, start over from the new anchors
+            self.anchor_signatures = anchor_signatures
+            self.anchor_entities = anchor_entities
+            self.floor = floor
+            start = 0
+            self.snapshots = [self.snapshot()]
+        else:
+            start = next((i for i, key in enumerate(self.order) if key in stale), len(self.order))
+            if start < len(self.order):
+                self.restore(self.snapshots[start])
+                del self.snapshots[start + 1:]
+
+        clean = [key for key in self.order[start:] if key not in stale]
+        self.order = self.order[:start]
+        for key in clean:
+            self.replay(key)
+            self.order.append(key)
+            self.snapshots.append(self.snapshot(graph.entity_anchor[self.index[key]]))
+        for key in dirty:
+            self.place(key)
+            self.order.append(key)
+            self.snapshots.append(self.snapshot(graph.entity_anchor[self.index[key]]))
+
+        for key in removed:
+            del self.results[key], self.fills[key]
+        self.signatures = signatures
+
+        self.placements = [anchor.to_placement() for anchor in self.anchor_entities]
+        self.placements += [self.results[key].to_placement() for key in keys if self.results[key] is not None]
+        return self.placements
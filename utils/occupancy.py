@@ -0,0 +1,318 @@
+import bisect
+import math
+
+import numpy as np
+
+
+class OccupancyMap:
+    """
+    Dense uint8 collision grid with an incrementally maintained summed-area table.
+    integral[r, c] holds the number of occupied cells in grid[:r, :c], so the
+    occupancy of any rectangle is four lookups regardless of its size.
+    x indexes columns and y indexes rows, h is the extent along x and w along y,
+    matching the convention of is_valid_position / update_collision_map.
+    """
+
+    def __init__(self, height, width):
+        self.grid = np.zeros((height, width), dtype=np.uint8)
+        self.integral = np.zeros((height + 1, width + 1), dtype=np.int32)
+        self.shared = False
+
+    def copy(self):
+        """Copy-on-write copy: arrays are shared until either side is filled."""
+        other = OccupancyMap.__new__(OccupancyMap)
+        other.grid, other.integral = self.grid, self.integral
+        self.shared = other.shared = True
+        return other
+
+    def restore(self, snapshot):
+        """Rolls back in place to a copy() taken earlier, the snapshot stays reusable."""
+        self.grid, self.integral = snapshot.grid, snapshot.integral
+        self.shared = snapshot.shared = True
+
+    @property
+    def shape(self):
+        return self.grid.shape
+
+    def area(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.grid.shape[1], x + h)
+        y0, y1 = max(0, y), min(self.grid.shape[0], y + w)
+        return max(0, x1 - x0) * max(0, y1 - y0)
+
+    def count(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.grid.shape[1], x + h)
+        y0, y1 = max(0, y), min(self.grid.shape[0], y + w)
+        if x1 <= x0 or y1 <= y0:
+            return 0
+        s = self.integral
+        return int(s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0])
+
+    def is_free(self, x, y, h, w):
+        return self.count(x, y, h, w) == 0
+
+    def fill(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.grid.shape[1], x + h)
+        y0, y1 = max(0, y), min(self.grid.shape[0], y + w)
+        if x1 <= x0 or y1 <= y0:
+            return
+        # only cells that flip 0 -> 1 change the table
+        delta = (1 - self.grid[y0:y1, x0:x1]).astype(np.int32)
+        if not delta.any():
+            return
+        if self.shared:
+            self.grid, self.integral = self.grid.copy(), self.integral.copy()
+            self.shared = False
+        block = self.grid[y0:y1, x0:x1]
+        block[...] = 1
+        c = delta.cumsum(axis=0).cumsum(axis=1)
+        s = self.integral
+        s[y0 + 1:y1 + 1, x0 + 1:x1 + 1] += c
+        s[y1 + 1:, x0 + 1:x1 + 1] += c[-1, :]
+        s[y0 + 1:y1 + 1, x1 + 1:] += c[:, -1:]
+        s[y1 + 1:, x1 + 1:] += c[-1, -1]
+
+    def free_positions(self, x_low, x_high, y_low, y_high, h, w):
+        """
+        All top-left corners (x, y) in the inclusive ranges whose h x w footprint
+        is free, as a box filter over the summed-area table. Bounds follow
+        is_valid_position, so the footprint must end strictly inside the grid.
+        """
+        height, width = self.grid.shape
+        x_low, x_high = max(x_low, 0), min(x_high, width - 1 - h)
+        y_low, y_high = max(y_low, 0), min(y_high, height - 1 - w)
+        if h <= 0 or w <= 0 or x_high < x_low or y_high < y_low:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        ys, xs = free_corners(self.integral, x_low, x_high, y_low, y_high, h, w)
+        return xs + x_low, ys + y_low
+
+
+EMPTY, MIXED, FULL = 0, 1, 2
+
+
+def free_corners(integral, x_low, x_high, y_low, y_high, h, w):
+    """Row and column offsets, relative to (y_low, x_low), of the free h x w boxes of a summed-area table."""
+    top, bottom = slice(y_low, y_high + 1), slice(y_low + w, y_high + w + 1)
+    left, right = slice(x_low, x_high + 1), slice(x_low + h, x_high + h + 1)
+    counts = integral[bottom, right] - integral[top, right] - integral[bottom, left] + integral[top, left]
+    return np.nonzero(counts == 0)
+
+
+class TiledOccupancyMap:
+    """
+    Coarse-to-fine occupancy for the stage floor. Coordinates are in cm like OccupancyMap,
+    the grid has one cell per resolution cm and is split into tile_size x tile_size tiles.
+    Only tiles that are partly occupied hold a dense OccupancyMap; empty and fully covered
+    tiles are a state flag, so memory follows the occupied boundary rather than the stage
+    area. Queries check tile states first and only descend into partly occupied tiles on
+    the border of the queried box. Cell coverage is conservative: a cell touched by a
+    footprint counts as occupied.
+    """
+
+    def __init__(self, height, width, resolution=1, tile_size=64):
+        self.height, self.width = height, width
+        self.resolution = resolution
+        self.tile_size = tile_size
+        self.rows, self.cols = math.ceil(height / resolution), math.ceil(width / resolution)
+        self.tile_state = np.zeros((math.ceil(self.rows / tile_size), math.ceil(self.cols / tile_size)), dtype=np.uint8)
+        self.tiles = {}
+        self.owned = set()
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    def copy(self):
+        """Copy-on-write copy: tiles are shared and only copied by the side that fills them."""
+        other = TiledOccupancyMap.__new__(TiledOccupancyMap)
+        other.__dict__.update(self.__dict__)
+        other.tile_state = self.tile_state.copy()
+        other.tiles = dict(self.tiles)
+        self.owned, other.owned = set(), set()
+        return other
+
+    def restore(self, snapshot):
+        """Rolls back in place to a copy() taken earlier, the snapshot stays reusable."""
+        self.tile_state = snapshot.tile_state.copy()
+        self.tiles = dict(snapshot.tiles)
+        self.owned, snapshot.owned = set(), set()
+
+    def cells(self, x, y, h, w):
+        r = self.resolution
+        c0, c1 = max(0, math.floor(x / r)), min(self.cols, math.ceil((x + h) / r))
+        r0, r1 = max(0, math.floor(y / r)), min(self.rows, math.ceil((y + w) / r))
+        return c0, c1, r0, r1
+
+    def overlapping_tiles(self, c0, c1, r0, r1):
+        """(ty, tx, state, local box) of every tile the cell box touches that is not empty."""
+        ts = self.tile_size
+        ty0, tx0 = r0 // ts, c0 // ts
+        states = self.tile_state[ty0:(r1 - 1) // ts + 1, tx0:(c1 - 1) // ts + 1]
+        for dy, dx in zip(*np.nonzero(states)):
+            ty, tx = ty0 + dy, tx0 + dx
+            lc0, lc1 = max(c0, tx * ts) - tx * ts, min(c1, (tx + 1) * ts) - tx * ts
+            lr0, lr1 = max(r0, ty * ts) - ty * ts, min(r1, (ty + 1) * ts) - ty * ts
+            yield ty, tx, states[dy, dx], (lc0, lr0, lc1 - lc0, lr1 - lr0)
+
+    def tile_extent(self, ty, tx):
+        ts = self.tile_size
+        return min(ts, self.rows - ty * ts), min(ts, self.cols - tx * ts)
+
+    def area(self, x, y, h, w):
+        c0, c1, r0, r1 = self.cells(x, y, h, w)
+        return max(0, c1 - c0) * max(0, r1 - r0)
+
+    def count(self, x, y, h, w):
+        c0, c1, r0, r1 = self.cells(x, y, h, w)
+        if c1 <= c0 or r1 <= r0:
+            return 0
+        total = 0
+        for ty, tx, state, (lx, ly, lh, lw) in self.overlapping_tiles(c0, c1, r0, r1):
+            total += lh * lw if state == FULL else self.tiles[ty, tx].count(lx, ly, lh, lw)
+        return total
+
+    def is_free(self, x, y, h, w):
+        c0, c1, r0, r1 = self.cells(x, y, h, w)
+        if c1 <= c0 or r1 <= r0:
+            return True
+        for ty, tx, state, (lx, ly, lh, lw) in self.overlapping_tiles(c0, c1, r0, r1):
+            if state == FULL or (lh, lw) == self.tile_extent(ty, tx)[::-1]:
+                return False
+            if not self.tiles[ty, tx].is_free(lx, ly, lh, lw):
+                return False
+        return True
+
+    def fill(self, x, y, h, w):
+        c0, c1, r0, r1 = self.cells(x, y, h, w)
+        if c1 <= c0 or r1 <= r0:
+            return
+        ts = self.tile_size
+        for ty in range(r0 // ts, (r1 - 1) // ts + 1):
+            for tx in range(c0 // ts, (c1 - 1) // ts + 1):
+                if self.tile_state[ty, tx] == FULL:
+                    continue
+                rows, cols = self.tile_extent(ty, tx)
+                lc0, lc1 = max(c0, tx * ts) - tx * ts, min(c1, (tx + 1) * ts) - tx * ts
+                lr0, lr1 = max(r0, ty * ts) - ty * ts, min(r1, (ty + 1) * ts) - ty * ts
+                if (lc1 - lc0, lr1 - lr0) == (cols, rows):
+                    self.tile_state[ty, tx] = FULL
+                    self.tiles.pop((ty, tx), None)
+                    continue
+                tile = self.tiles.get((ty, tx))
+                if tile is None:
+                    tile = self.tiles[ty, tx] = OccupancyMap(rows, cols)
+                    self.tile_state[ty, tx] = MIXED
+                    self.owned.add((ty, tx))
+                elif (ty, tx) not in self.owned:
+                    tile = self.tiles[ty, tx] = tile.copy()
+                    self.owned.add((ty, tx))
+                tile.fill(lc0, lr0, lc1 - lc0, lr1 - lr0)
+                if tile.integral[-1, -1] == rows * cols:
+                    self.tile_state[ty, tx] = FULL
+                    del self.tiles[ty, tx]
+
+    def window(self, c0, c1, r0, r1):
+        """Dense uint8 copy of the cells [r0, r1) x [c0, c1)."""
+        grid = np.zeros((r1 - r0, c1 - c0), dtype=np.uint8)
+        ts = self.tile_size
+        for ty, tx, state, (lx, ly, lh, lw) in self.overlapping_tiles(c0, c1, r0, r1):
+            gy, gx = ty * ts + ly - r0, tx * ts + lx - c0
+            if state == FULL:
+                grid[gy:gy + lw, gx:gx + lh] = 1
+            else:
+                grid[gy:gy + lw, gx:gx + lh] = self.tiles[ty, tx].grid[ly:ly + lw, lx:lx + lh]
+        return grid
+
+    def free_positions(self, x_low, x_high, y_low, y_high, h, w):
+        """Same contract as OccupancyMap.free_positions, positions are multiples of the resolution."""
+        r = self.resolution
+        empty = np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        if h <= 0 or w <= 0:
+            return empty
+        cx_low, cx_high = math.ceil(max(x_low, 0) / r), math.floor(min(x_high, self.width - 1 - h) / r)
+        cy_low, cy_high = math.ceil(max(y_low, 0) / r), math.floor(min(y_high, self.height - 1 - w) / r)
+        if cx_high < cx_low or cy_high < cy_low:
+            return empty
+        hc, wc = math.ceil(h / r), math.ceil(w / r)
+        c1, r1 = min(self.cols, cx_high + hc), min(self.rows, cy_high + wc)
+        grid = self.window(cx_low, c1, cy_low, r1)
+        integral = np.zeros((grid.shape[0] + 1, grid.shape[1] + 1), dtype=np.int32)
+        integral[1:, 1:] = grid.cumsum(axis=0).cumsum(axis=1)
+        ys, xs = free_corners(integral, 0, cx_high - cx_low, 0, cy_high - cy_low, hc, wc)
+        return (xs + cx_low) * r, (ys + cy_low) * r
+
+
+class IntervalSurface:
+    """
+    Occupancy of a wall-type anchor surface (height x length in cm) as a list of placed
+    boxes sorted by their left edge. Attached entities sit in a fixed height band, so a
+    surface only ever holds a handful of boxes and queries are interval searches instead
+    of grid scans. Same interface as OccupancyMap.
+    """
+
+    def __init__(self, height, width):
+        self.height, self.width = height, width
+        self.boxes = []  # (x0, x1, y0, y1), sorted by x0
+
+    @property
+    def shape(self):
+        return (self.height, self.width)
+
+    def copy(self):
+        other = IntervalSurface(self.height, self.width)
+        other.boxes = list(self.boxes)
+        return other
+
+    def restore(self, snapshot):
+        self.boxes = list(snapshot.boxes)
+
+    def overlapping(self, x, y, h, w):
+        end = bisect.bisect_left(self.boxes, (x + h,))
+        for x0, x1, y0, y1 in self.boxes[:end]:
+            if x1 > x and y0 < y + w and y1 > y:
+                yield max(x0, x), min(x1, x + h), max(y0, y), min(y1, y + w)
+
+    def area(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.width, x + h)
+        y0, y1 = max(0, y), min(self.height, y + w)
+        return max(0, x1 - x0) * max(0, y1 - y0)
+
+    def count(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.width, x + h)
+        y0, y1 = max(0, y), min(self.height, y + w)
+        if x1 <= x0 or y1 <= y0:
+            return 0
+        # boxes are only filled after a free check, so they do not overlap each other
+        return sum((bx1 - bx0) * (by1 - by0) for bx0, bx1, by0, by1 in self.overlapping(x0, y0, x1 - x0, y1 - y0))
+
+    def is_free(self, x, y, h, w):
+        return next(self.overlapping(x, y, h, w), None) is None
+
+    def fill(self, x, y, h, w):
+        x0, x1 = max(0, x), min(self.width, x + h)
+        y0, y1 = max(0, y), min(self.height, y + w)
+        if x1 <= x0 or y1 <= y0:
+            return
+        bisect.insort(self.boxes, (x0, x1, y0, y1))
+
+    def free_positions(self, x_low, x_high, y_low, y_high, h, w):
+        """Same contract as OccupancyMap.free_positions, computed from the blocked x intervals of each row."""
+        x_low, x_high = max(x_low, 0), min(x_high, self.width - 1 - h)
+        y_low, y_high = max(y_low, 0), min(y_high, self.height - 1 - w)
+        if h <= 0 or w <= 0 or x_high < x_low or y_high < y_low:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        xs, ys = [], []
+        for y in range(y_low, y_high + 1):
+            # a box [x0, x1) blocks the left edges (x0 - h, x1)
+            blocked = sorted((x0 - h + 1, x1 - 1) for x0, x1, y0, y1 in self.boxes if y0 < y + w and y1 > y)
+            start = x_low
+            for block_low, block_high in blocked + [(x_high + 1, x_high + 1)]:
+                if block_low > start:
+                    free = np.arange(start, min(block_low, x_high + 1))
+                    xs.append(free)
+                    ys.append(np.full(len(free), y))
+                start = max(start, block_high + 1)
+                if start > x_high:
+                    break
+        if not xs:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        return np.concatenate(xs), np.concatenate(ys)
@@ -0,0 +1,228 @@
+"""
+Placement micro-benchmark on synthetic scenes.
+
+    python -m utils.placement_benchmark --anchors 20 --ornaments 200 --repeats 5 --output bench.json
+
+Scenes follow the anchor_generater / ornament_generator JSON schema, so they go through the
+same parsing as LLM output. Results are one JSON document with per-rule latency percentiles,
+attempts per success, failure rate and the peak traced memory of a full layout.
+"""
+
+import argparse
+import contextlib
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from utils.placement_rules import (
+    STAGE_SIZE,
+    initialize_floor_map,
+    parse_anchor_prompt_data,
+    parse_ornament_prompt_data,
+    place_non_anchor,
+)
+from utils.scene_graph import SceneGraph
+
+RULES = ['place_beside', 'place_top', 'place_attach', 'place_corner', 'place_center']
+DEFAULT_RULE_MIX = {'place_beside': 0.35, 'place_top': 0.2, 'place_attach': 0.2, 'place_corner': 0.1, 'place_center': 0.15}
+
+
+def sample_dimensions(rng, size_range, size_dist):
+    low, high = size_range
+    if size_dist == 'uniform':
+        return [rng.randint(low, high) for _ in range(3)]
+    if size_dist == 'lognormal':
+        # geometric mean of the range as median, so most samples stay inside it
+        mu, sigma = (np.log(low) + np.log(high)) / 2, (np.log(high) - np.log(low)) / 4
+        return [int(min(high, max(low, round(rng.lognormvariate(mu, sigma))))) for _ in range(3)]
+    raise ValueError(f"Unknown size distribution: {size_dist}")
+
+
+def synthetic_scene(n_anchors, n_ornaments, rule_mix=None, anchor_size=(40, 300), ornament_size=(10, 80),
+                    size_dist='uniform', grouped_fraction=0.3, seed=0, stage_size=STAGE_SIZE):
+    """
+    Returns (anchor_text, ornament_text) JSON strings with n_anchors non-overlapping anchors and
+    n_ornaments ornaments whose rules are drawn from rule_mix. A grouped_fraction of the
+    anchor-bound ornaments is listed under its anchor group as anchor_generater does, the rest
+    names its anchor in the rule as ornament_generator does.
+    """
+    rng = random.Random(seed)
+    rule_mix = rule_mix or DEFAULT_RULE_MIX
+    rules, weights = zip(*rule_mix.items())
+
+    groups = []
+    occupied = []
+    for i in range(n_anchors):
+        for _ in range(1000):
+            length, width, height = sample_dimensions(rng, anchor_size, size_dist)
+            x_left, y_left = rng.randint(0, stage_size[0] - 1 - length), rng.randint(0, stage_size[1] - 1 - width)
+            box = (x_left, y_left, x_left + length, y_left + width)
+            if not any(box[0] < o[2] and o[0] < box[2] and box[1] < o[3] and o[1] < box[3] for o in occupied):
+                break
+        else:
+            break
+        occupied.append(box)
+        groups.append({
+            "anchor_entity": {
+                "name": f"anchor{i}",
+                "description": f"synthetic anchor {i}",
+                "dimensions": [length, width, height],
+                "left": [box[0], box[1]],
+                "right": [box[2], box[3]],
+                "h": [0, height]
+            },
+            "non_anchor_entities": []
+        })
+
+    ornaments = []
+    for i in range(n_ornaments):
+        rule = rng.choices(rules, weights=weights)[0]
+        dimensions = sample_dimensions(rng, ornament_size, size_dist)
+        entity = {"name": f"ornament{i}", "description": f"synthetic ornament {i}", "dimensions": dimensions}
+        if not groups and rule not in ('place_corner', 'place_center'):
+            rule = 'place_center'
+        if rule in ('place_corner', 'place_center'):
+            entity["placement_rule"] = f"{rule}()"
+            ornaments.append(entity)
+            continue
+
+        group = rng.choice(groups)
+        anchor = group["anchor_entity"]
+        grouped = rng.random() < grouped_fraction
+        anchor_ref = "" if grouped else anchor["name"]
+        if rule == 'place_attach':
+            anchor_height = anchor["h"][1]
+            dimensions[2] = min(dimensions[2], anchor_height)
+            h_low = rng.randint(0, anchor_height - dimensions[2])
+            args = [str(h_low), str(h_low + dimensions[2])] + ([anchor_ref] if anchor_ref else [])
+            entity["placement_rule"] = f"place_attach({', '.join(args)})"
+        else:
+            entity["placement_rule"] = f"{rule}({anchor_ref})"
+
+        if grouped:
+            group["non_anchor_entities"].append(entity)
+        else:
+            ornaments.append(entity)
+
+    return json.dumps(groups), json.dumps(ornaments)
+
+
+def run_scene(anchor_text, ornament_text, exhaustive, seed, records, stage_size=STAGE_SIZE, resolution=1):
+    rng = random.Random(seed)
+    floor_collision_map = initialize_floor_map(stage_size, resolution)
+    anchor_entities, non_anchor_entities = parse_anchor_prompt_data(anchor_text, floor_collision_map)
+    non_anchor_entities = parse_ornament_prompt_data(ornament_text, non_anchor_entities)
+    graph = SceneGraph(anchor_entities, non_anchor_entities)
+    for i, entity in enumerate(non_anchor_entities):
+        stats = {}
+        start = time.perf_counter()
+        rectangle = place_non_anchor(entity, graph.anchor_of(i), floor_collision_map, exhaustive, rng, stats)
+        elapsed = time.perf_counter() - start
+        if records is not None:
+            records.append((graph.rules[i].kind, elapsed, stats.get('attempts', 0), rectangle is not None))
+
+
+def summarize(records):
+    summary = {}
+    for rule in RULES + ['total']:
+        selected = [r for r in records if rule == 'total' or r[0] == rule]
+        if not selected:
+            continue
+        latencies = np.array([r[1] for r in selected]) * 1000
+        successes = sum(r[3] for r in selected)
+        summary[rule] = {
+            "count": len(selected),
+            "latency_ms": {
+                "mean": float(latencies.mean()),
+                "p50": float(np.percentile(latencies, 50)),
+                "p90": float(np.percentile(latencies, 90)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(latencies.max())
+            },
+            "attempts_per_success": sum(r[2] for r in selected) / successes if successes else None,
+            "failure_rate": 1 - successes / len(selected)
+        }
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(n_anchors=10, n_ornaments=60, repeats=5, exhaustive=False, rule_mix=None, anchor_size=(40, 300),
+              ornament_size=(10, 80), size_dist='uniform', grouped_fraction=0.3, seed=0, stage_size=STAGE_SIZE,
+              resolution=1):
+    records = []
+    peak_bytes = []
+    layout_seconds = []
+    for repeat in range(repeats):
+        anchor_text, ornament_text = synthetic_scene(n_anchors, n_ornaments, rule_mix, anchor_size, ornament_size,
+                                                     size_dist, grouped_fraction, seed + repeat, stage_size)
+        start = time.perf_counter()
+        run_scene(anchor_text, ornament_text, exhaustive, seed + repeat, records, stage_size, resolution)
+        layout_seconds.append(time.perf_counter() - start)
+
+        # separate pass, tracemalloc would skew the timings above
+        tracemalloc.start()
+        run_scene(anchor_text, ornament_text, exhaustive, seed + repeat, None, stage_size, resolution)
+        peak_bytes.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "commit": git_commit(),
+        "config": {
+            "anchors": n_anchors, "ornaments": n_ornaments, "repeats": repeats, "exhaustive": exhaustive,
+            "rule_mix": rule_mix or DEFAULT_RULE_MIX, "anchor_size": list(anchor_size),
+            "ornament_size": list(ornament_size), "size_dist": size_dist,
+            "grouped_fraction": grouped_fraction, "seed": seed, "stage_size": list(stage_size),
+            "resolution": resolution
+        },
+        "rules": summarize(records),
+        "layout_seconds": {"mean": float(np.mean(layout_seconds)), "max": float(np.max(layout_seconds))},
+        "peak_memory_bytes": int(max(peak_bytes))
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark foreground placement on synthetic scenes')
+    parser.add_argument('--anchors', type=int, default=10, help='Number of anchors per scene')
+    parser.add_argument('--ornaments', type=int, default=60, help='Number of ornaments per scene')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of scenes, each with its own seed')
+    parser.add_argument('--exhaustive', action='store_true', help='Use exhaustive position search')
+    parser.add_argument('--rule_mix', type=str, default=None, help='JSON object of rule weights, e.g. {"place_top": 1}')
+    parser.add_argument('--anchor_size', type=int, nargs=2, default=[40, 300], help='Anchor dimension range in cm')
+    parser.add_argument('--ornament_size', type=int, nargs=2, default=[10, 80], help='Ornament dimension range in cm')
+    parser.add_argument('--size_dist', type=str, default='uniform', choices=['uniform', 'lognormal'])
+    parser.add_argument('--grouped_fraction', type=float, default=0.3, help='Share of ornaments listed in anchor groups')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stage_size', type=int, nargs=2, default=list(STAGE_SIZE), help='Stage width and depth in cm')
+    parser.add_argument('--resolution', type=int, default=1, help='Floor grid cell size in cm')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON results here instead of stdout')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    # placement diagnostics go to stderr so stdout stays valid JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        results = benchmark(args.anchors, args.ornaments, args.repeats, args.exhaustive,
+                            json.loads(args.rule_mix) if args.rule_mix else None, tuple(args.anchor_size),
+                            tuple(args.ornament_size), args.size_dist, args.grouped_fraction, args.seed,
+                            tuple(args.stage_size), args.resolution)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
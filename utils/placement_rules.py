@@ -1,12 +1,17 @@
-import numpy as np
 import random
 import json
 import pdb
-import re
 import math
+import time
+from functools import partial
+from utils.occupancy import IntervalSurface, OccupancyMap, TiledOccupancyMap
+from utils.scene_graph import SceneGraph, get_rule
 
 
 class Rectangle:
+    __slots__ = ('x_left', 'y_left', 'x_right', 'y_right', 'height_low', 'height_high', 'name', 'orientation',
+                 'surface_collision_maps', 'description')
+
     def __init__(self, x_left, y_left, x_right, y_right, height_low, height_high, name=None, orientation='front', description=None):
         self.x_left = x_left
         self.y_left = y_left
@@ -37,10 +42,31 @@ class Rectangle:
     def get_bounding_box(self):
         return [self.x_left, self.y_left, self.x_right, self.y_right, self.height_low, self.height_high]
 
-def anchor_angle(anchor):
-    if (anchor["left"][0] + anchor["right"][0]) / 2 > 950:
+    def to_placement(self):
+        return {
+            "name": self.name,
+            "orientation": self.orientation,
+            "position": self.get_bounding_box(),
+            "description": self.description
+        }
+
+    def get_surface_map(self, surface):
+        # surfaces are allocated on first use, most anchors never carry an ornament
+        surface_map = self.surface_collision_maps[surface]
+        if surface_map is None:
+            if surface == 'top_surface':
+                surface_map = initialize_collision_map(self.y_right - self.y_left, self.x_right - self.x_left)
+            elif surface == 'front_surface':
+                surface_map = IntervalSurface(self.height_high - self.height_low, self.x_right - self.x_left)
+            else:
+                surface_map = IntervalSurface(self.height_high - self.height_low, self.y_right - self.y_left)
+            self.surface_collision_maps[surface] = surface_map
+        return surface_map
+
+def anchor_angle(anchor, stage_width=1000):
+    if (anchor["left"][0] + anchor["right"][0]) / 2 > 0.95 * stage_width:
         return "left"
-    elif (anchor["left"][0] + anchor["right"][0]) / 2 < 250:
+    elif (anchor["left"][0] + anchor["right"][0]) / 2 < 0.25 * stage_width:
         return "right"
     return "front"
 
@@ -60,21 +86,11 @@ def parse_anchor_prompt_data(text, collision_map):
             height_low = anchor_data["h"][0],
             height_high = anchor_data["h"][1],
             name = anchor_data["name"],
-            orientation = anchor_angle(anchor_data),
+            orientation = anchor_angle(anchor_data, collision_map.shape[1]),
             description = anchor_data['description']
         )
         anchor_entities.append(anchor_rect)
 
-        anchor_rect.surface_collision_maps['front_surface'] = initialize_collision_map(
-            anchor_rect.height_high - anchor_rect.height_low, anchor_rect.x_right - anchor_rect.x_left)
-        anchor_rect.surface_collision_maps['left_surface'] = initialize_collision_map(
-            anchor_rect.height_high - anchor_rect.height_low, anchor_rect.y_right - anchor_rect.y_left)
-        anchor_rect.surface_collision_maps['right_surface'] = initialize_collision_map(
-            anchor_rect.height_high - anchor_rect.height_low, anchor_rect.y_right - anchor_rect.y_left)
-        anchor_rect.surface_collision_maps['top_surface'] = initialize_collision_map(
-            anchor_rect.y_right - anchor_rect.y_left, anchor_rect.x_right - anchor_rect.x_left
-        )
-  
         update_collision_map(collision_map, anchor_rect.x_left, anchor_rect.y_left, anchor_rect.x_left - anchor_rect.x_right, anchor_rect.y_right - anchor_rect.y_left)
  
         non_anchors = item.get("non_anchor_entities", [])
@@ -87,21 +103,21 @@ def parse_anchor_prompt_data(text, collision_map):
 def parse_ornament_prompt_data(text, non_anchor_entities):
     entities = json.loads(text)
     for item in entities:
-        if any(rule in item['placement_rule'] for rule in ['place_beside', 'place_top']):
-            item["anchor_name"] = item['placement_rule'].split('(')[1].split(')')[0] 
-        elif 'place_attach' in item['placement_rule']:
-            content = item['placement_rule'][item['placement_rule'].find('(') + 1 : item['placement_rule'].rfind(')')]    
-            parts = [part.strip() for part in content.split(',')]
-            item["anchor_name"] = parts[2]
-        else:
-            item["anchor_name"] = None   
+        item["anchor_name"] = get_rule(item).anchor
         non_anchor_entities.append(item)
 
     return non_anchor_entities
 
 
+STAGE_SIZE = (1000, 1000)
+
 def initialize_collision_map(height, width):
-    return np.zeros((height, width), dtype=np.uint8) 
+    return OccupancyMap(height, width)
+
+def initialize_floor_map(stage_size=STAGE_SIZE, resolution=1):
+    """Floor occupancy of a stage_size = (width, depth) cm stage with one cell per resolution cm."""
+    stage_width, stage_depth = stage_size
+    return TiledOccupancyMap(stage_depth, stage_width, resolution)
 
 def is_valid_position(x, y, h, w, collision_map):
     if x is None or y is None or h <= 0 or w <= 0:
@@ -112,30 +128,76 @@ def is_valid_position(x, y, h, w, collision_map):
     if not (0 <= y + w < collision_map.shape[0] and 0 <= x + h < collision_map.shape[1]):
         return False
 
- 
-    if 1 in collision_map[max(0, y):min(collision_map.shape[0], y + w),
-                          max(0, x):min(collision_map.shape[1], x + h)]:
-        return False
+    return collision_map.is_free(x, y, h, w)
+
+
+def update_collision_map(collision_map, x, y, h, w, stats=None):
+    if stats is not None:
+        # the raw arguments, replaying them reproduces the fill exactly
+        stats.setdefault('fills', []).append((collision_map, x, y, h, w))
+
+    height, width = collision_map.shape
+    x = min(width - 1, max(0, math.ceil(x)))
+    y = min(height - 1, max(0, math.ceil(y)))
+    h = min(width - 1, max(0, math.ceil(h)))
+    w = min(height - 1, max(0, math.ceil(w)))
+
+    collision_map.fill(x, y, h, w)
 
-    return np.all(collision_map[y:y + w, x:x + h] == 0)
 
+MAX_ATTEMPTS = 5000
 
-def update_collision_map(collision_map, x, y, h, w):
+def count_attempts(stats, attempts):
+    if stats is not None:
+        stats['attempts'] = stats.get('attempts', 0) + attempts
+
+def note(stats, key, value):
+    if stats is not None:
+        stats.setdefault(key, []).append(value)
+
+def search_position(collision_map, candidates, exhaustive=False, rng=random, stats=None):
+    """
+    candidates: list of (key, x_low, x_high, y_low, y_high, h, w), one per footprint option.
+    Returns (key, x, y) or None. rng is the random module or a random.Random stream.
+    If stats is a dict, stats['attempts'] accumulates the probed positions (sampling) or
+    the enumerated candidates (exhaustive).
+    The default mode samples a random candidate and position up to MAX_ATTEMPTS times.
+    The exhaustive mode enumerates every free position of every candidate and draws from
+    the same distribution the sampler converges to: a candidate is weighted by the share
+    of its range that is free, then a position is picked uniformly among its free ones.
+    """
+    if not candidates:
+        return None
+    if not exhaustive:
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            key, x_low, x_high, y_low, y_high, h, w = rng.choice(candidates)
+            x = rng.randint(x_low, x_high)
+            y = rng.randint(y_low, y_high)
+            if is_valid_position(x, y, h, w, collision_map):
+                count_attempts(stats, attempt)
+                return key, x, y
+        count_attempts(stats, MAX_ATTEMPTS)
+        return None
 
-    x = min(999, max(0, math.ceil(x)))
-    y = min(999, max(0, math.ceil(y)))
-    h = min(999, max(0, math.ceil(h)))
-    w = min(999, max(0, math.ceil(w)))
-   
-    collision_map[max(0, y):min(collision_map.shape[0], y + w),
-                  max(0, x):min(collision_map.shape[1], x + h)] = 1 
+    count_attempts(stats, len(candidates))
+    free, weights = [], []
+    for key, x_low, x_high, y_low, y_high, h, w in candidates:
+        xs, ys = collision_map.free_positions(x_low, x_high, y_low, y_high, h, w)
+        free.append((key, xs, ys))
+        weights.append(len(xs) / ((x_high - x_low + 1) * (y_high - y_low + 1)))
+    if sum(weights) == 0:
+        return None
+    key, xs, ys = rng.choices(free, weights=weights)[0]
+    i = rng.randrange(len(xs))
+    return key, int(xs[i]), int(ys[i])
 
 
-def place_entity(anchor, entity, collision_map):
+def place_entity(anchor, entity, collision_map, exhaustive=False, rng=random, stats=None):
     anchor_x_left, anchor_y_left, anchor_x_right, anchor_y_right, anchor_height_low, anchor_height_high = anchor.get_bounding_box()
     entity_length, entity_width, entity_height = entity['dimensions']
+    rule = get_rule(entity)
 
-    if "place_beside" in entity["placement_rule"]:
+    if rule.kind == 'place_beside':
         surfaces = ['front', 'left', 'right']
         
         search_area_back = anchor_y_left - 150  
@@ -144,124 +206,110 @@ def place_entity(anchor, entity, collision_map):
         search_area_right = anchor_x_right + 150  
 
         while surfaces:
-            angle = random.choice(surfaces)
+            angle = rng.choice(surfaces)
+            note(stats, 'surfaces', angle)
             if angle == 'front':
                 left_bound = search_area_left - entity_length
-                for _ in range(5000): 
-                    x_offset = random.randint(0, search_area_right - left_bound)
-                    y_offset = random.randint(0, search_area_front - anchor_y_right)
-                    place_left = left_bound + x_offset
-                    place_back = anchor_y_right + y_offset
-
-                    if is_valid_position(place_left, place_back, entity_length, entity_width, collision_map):
-                        update_collision_map(collision_map, place_left, place_back, entity_length, entity_width)
-                        return Rectangle(
-                            place_left,
-                            place_back,
-                            place_left + entity_length,
-                            place_back + entity_width,
-                            anchor_height_low,
-                            anchor_height_low + entity_height,
-                            name=entity['name'],
-                            orientation='front',
-                            description=entity['description']
-                        )
+                found = search_position(collision_map, [(angle, left_bound, search_area_right, anchor_y_right, search_area_front,
+                                                         entity_length, entity_width)], exhaustive, rng, stats)
+                if found:
+                    _, place_left, place_back = found
+                    update_collision_map(collision_map, place_left, place_back, entity_length, entity_width, stats)
+                    return Rectangle(
+                        place_left,
+                        place_back,
+                        place_left + entity_length,
+                        place_back + entity_width,
+                        anchor_height_low,
+                        anchor_height_low + entity_height,
+                        name=entity['name'],
+                        orientation='front',
+                        description=entity['description']
+                    )
 
             elif angle == 'left':
                 front_bound = search_area_front + entity_length
-                for _ in range(5000):
-                    x_offset = random.randint(0, anchor_x_left - search_area_left)
-                    y_offset = random.randint(0, front_bound - search_area_back)
-                    place_left = anchor_x_left - x_offset - entity_width 
-                    place_back = search_area_back + y_offset - entity_length
-
-                    if is_valid_position(place_left, place_back, entity_width, entity_length, collision_map):
-                        update_collision_map(collision_map, place_left, place_back, entity_width, entity_length)
-                        return Rectangle(
-                            place_left,
-                            place_back,
-                            place_left + entity_width,
-                            place_back + entity_height,
-                            anchor_height_low,
-                            anchor_height_low + entity_height,
-                            name=entity['name'],
-                            orientation='right',
-                            description=entity['description']
-                        )
+                found = search_position(collision_map, [(angle, search_area_left - entity_width, anchor_x_left - entity_width,
+                                                         search_area_back - entity_length, front_bound - entity_length,
+                                                         entity_width, entity_length)], exhaustive, rng, stats)
+                if found:
+                    _, place_left, place_back = found
+                    update_collision_map(collision_map, place_left, place_back, entity_width, entity_length, stats)
+                    return Rectangle(
+                        place_left,
+                        place_back,
+                        place_left + entity_width,
+                        place_back + entity_height,
+                        anchor_height_low,
+                        anchor_height_low + entity_height,
+                        name=entity['name'],
+                        orientation='right',
+                        description=entity['description']
+                    )
 
             else:
                 back_bound = search_area_back - entity_length
-                for _ in range(5000):
-                    x_offset = random.randint(0, search_area_right - anchor_x_right)
-                    y_offset = random.randint(0, search_area_front - back_bound)
-                    place_left = anchor_x_right + x_offset
-                    place_back = back_bound + y_offset
-
-                    if is_valid_position(place_left, place_back, entity_width, entity_length, collision_map):
-                        update_collision_map(collision_map, place_left, place_back, entity_width, entity_length)
-                        return Rectangle(
-                            place_left,
-                            place_back,
-                            place_left + entity_width,
-                            place_back + entity_length,
-                            anchor_height_low,
-                            anchor_height_low + entity_height,
-                            name=entity['name'],
-                            orientation='left',
-                            description=entity['description']
-                        )
+                found = search_position(collision_map, [(angle, anchor_x_right, search_area_right, back_bound, search_area_front,
+                                                         entity_width, entity_length)], exhaustive, rng, stats)
+                if found:
+                    _, place_left, place_back = found
+                    update_collision_map(collision_map, place_left, place_back, entity_width, entity_length, stats)
+                    return Rectangle(
+                        place_left,
+                        place_back,
+                        place_left + entity_width,
+                        place_back + entity_length,
+                        anchor_height_low,
+                        anchor_height_low + entity_height,
+                        name=entity['name'],
+                        orientation='left',
+                        description=entity['description']
+                    )
             
             surfaces.remove(angle)
         
 
-    elif "place_top" in entity["placement_rule"]:
-        surface_collision_map = anchor.surface_collision_maps['top_surface']
-        MAX_ATTEMPTS = 5000 
-        surfaces = ['front', 'left', 'right']
-        for _ in range(MAX_ATTEMPTS):
-            if surfaces == []:
-                return None
-            orientation = random.choice(surfaces)
+    elif rule.kind == 'place_top':
+        surface_collision_map = anchor.get_surface_map('top_surface')
+        note(stats, 'surfaces', 'top_surface')
+        candidates = []
+        for orientation in ['front', 'left', 'right']:
             if orientation == 'front':
                 x = entity_width
                 y = entity_length
                 if surface_collision_map.shape[0] - x <0 or surface_collision_map.shape[1] - y <0 :
-                    print(anchor.name)
-                    print(surface_collision_map.shape[0])
-                    print(surface_collision_map.shape[1])
-                    surfaces.remove(orientation)
+                    note(stats, 'notes', f"Entity {entity['name']} does not fit facing front on top of {anchor.name} "
+                                         f"({surface_collision_map.shape[0]}x{surface_collision_map.shape[1]}).")
                     continue
-            elif orientation == 'left' or orientation == 'right':
+            else:
                 x = entity_length
                 y = entity_width
                 if surface_collision_map.shape[0] - x <0 or surface_collision_map.shape[1] - y <0 :
-                    surfaces.remove(orientation)
-                    continue        
-            place_back = random.randint(0, surface_collision_map.shape[0] - x)
-            place_left = random.randint(0, surface_collision_map.shape[1] - y)
-            if is_valid_position(place_left, place_back, y, x, surface_collision_map):
-                update_collision_map(surface_collision_map, place_left, place_back, y, x)
-                return Rectangle(
-                    place_left + anchor_x_left,
-                    place_back + anchor_y_left,
-                    place_left + anchor_x_left + y,
-                    place_back + anchor_y_left + x,
-                    anchor_height_high,
-                    anchor_height_high + entity_height,
-                    name = entity['name'],
-                    orientation = orientation,
-                    description = entity['description']
-                )
-
-    elif "place_attach" in entity["placement_rule"]:
-        def extract_first_two_numbers(rule):
-            numbers = re.findall(r'\d+', rule)         
-            if len(numbers) < 2:
-                raise ValueError("Placement rule must contain at least two integers.")
-            h_low, h_high = map(int, numbers[:2])
-            return h_low, h_high
-
-        h_low, h_high = extract_first_two_numbers(entity["placement_rule"])
+                    continue
+            candidates.append((orientation, 0, surface_collision_map.shape[1] - y, 0, surface_collision_map.shape[0] - x, y, x))
+
+        found = search_position(surface_collision_map, candidates, exhaustive, rng, stats)
+        if found:
+            orientation, place_left, place_back = found
+            y, x = (entity_length, entity_width) if orientation == 'front' else (entity_width, entity_length)
+            update_collision_map(surface_collision_map, place_left, place_back, y, x, stats)
+            return Rectangle(
+                place_left + anchor_x_left,
+                place_back + anchor_y_left,
+                place_left + anchor_x_left + y,
+                place_back + anchor_y_left + x,
+                anchor_height_high,
+                anchor_height_high + entity_height,
+                name = entity['name'],
+                orientation = orientation,
+                description = entity['description']
+            )
+        return None
+
+    elif rule.kind == 'place_attach':
+        if rule.h_low is None:
+            raise ValueError("Placement rule must contain at least two integers.")
+        h_low, h_high = rule.h_low, rule.h_high
         anchor_orientation = getattr(anchor, 'orientation', 'front')
         surfaces = []
 
@@ -273,70 +321,65 @@ def place_entity(anchor, entity, collision_map):
             surfaces = ['right_surface']
 
         while surfaces:
-            chosen_surface = random.choice(surfaces)
-            surface_collision_map = anchor.surface_collision_maps[chosen_surface]
+            chosen_surface = rng.choice(surfaces)
+            note(stats, 'surfaces', chosen_surface)
+            surface_collision_map = anchor.get_surface_map(chosen_surface)
             if surface_collision_map.shape[1] < entity_length:
                 surfaces.remove(chosen_surface)
                 continue  
-            MAX_ATTEMPTS = 5000  
-            for _ in range(MAX_ATTEMPTS):
-                x_offset = random.randint(0, surface_collision_map.shape[1] - entity_length)
+            place_back = surface_collision_map.shape[0] - h_high
+            stage_depth, stage_width = collision_map.shape
+            # the footprint on the floor must stay on stage, which bounds the offset along the surface
+            if chosen_surface == 'front_surface':
+                global_y = anchor_y_right + entity_width
+                x_low = max(0, -anchor_x_left)
+                x_high = min(surface_collision_map.shape[1] - entity_length, stage_width - 1 - entity_length - anchor_x_left)
+                on_stage = 0 <= global_y and global_y + entity_width <= stage_depth - 1
+            else:
+                global_x = anchor_x_left - entity_width if chosen_surface == 'left_surface' else anchor_x_right
+                x_low = max(0, -anchor_y_left)
+                x_high = min(surface_collision_map.shape[1] - entity_length, stage_depth - 1 - entity_length - anchor_y_left)
+                on_stage = 0 <= global_x and global_x + entity_width <= stage_width - 1
+
+            found = None
+            if on_stage and x_low <= x_high:
+                found = search_position(surface_collision_map, [(chosen_surface, x_low, x_high, place_back, place_back,
+                                                                 entity_length, entity_height)], exhaustive, rng, stats)
+            if found:
+                _, place_left, place_back = found
+                update_collision_map(surface_collision_map, place_left, place_back, entity_length, entity_height, stats)
                 if chosen_surface == 'front_surface':
-                    place_left = x_offset
-                    place_back = surface_collision_map.shape[0] - h_high
                     global_x = place_left + anchor_x_left
-                    global_y = anchor_y_right + entity_width
-                    
-                    if is_valid_position(place_left, place_back, entity_length, entity_height, surface_collision_map) and \
-                    all(0 <= coord <= 999 for coord in [global_x, global_y, global_x + entity_length, global_y + entity_width]):
-                        update_collision_map(surface_collision_map, place_left, place_back, entity_length, entity_height)
-                        update_collision_map(collision_map, global_x, global_y, entity_length, entity_width)
-                        return Rectangle(global_x, global_y, global_x + entity_length, global_y + entity_width,
-                                        h_low, h_high, name=entity['name'], orientation='front', description=entity['description'])
-
-                elif chosen_surface == 'left_surface':
-                    place_left = x_offset
-                    place_back = surface_collision_map.shape[0] - h_high
-                    global_x = anchor_x_left - entity_width
-                    global_y = place_left + anchor_y_left
-
-                    if is_valid_position(place_left, place_back, entity_length, entity_height, surface_collision_map) and \
-                    all(0 <= coord <= 999 for coord in [global_x, global_y, global_x + entity_width, global_y + entity_length]):
-                        update_collision_map(surface_collision_map, place_left, place_back, entity_length, entity_height)
-                        update_collision_map(collision_map, global_x, global_y, entity_width, entity_length)
-                        return Rectangle(global_x, global_y, global_x + entity_width, global_y + entity_length,
-                                        h_low, h_high, name=entity['name'], orientation='left', description=entity['description'])
-
-                elif chosen_surface == 'right_surface':
-                    place_left = x_offset
-                    place_back = surface_collision_map.shape[0] - h_high
-                    global_x = anchor_x_right
-                    global_y = place_left + anchor_y_left
-
-                    if is_valid_position(place_left, place_back, entity_length, entity_height, surface_collision_map) and \
-                    all(0 <= coord <= 999 for coord in [global_x, global_y, global_x + entity_width, global_y + entity_length]):
-                        update_collision_map(surface_collision_map, place_left, place_back, entity_length, entity_height)
-                        update_collision_map(collision_map, global_x, global_y, entity_width, entity_length)
-                        return Rectangle(global_x, global_y, global_x + entity_width, global_y + entity_length,
-                                        h_low, h_high, name=entity['name'], orientation='right', description=entity['description'])
+                    update_collision_map(collision_map, global_x, global_y, entity_length, entity_width, stats)
+                    return Rectangle(global_x, global_y, global_x + entity_length, global_y + entity_width,
+                                    h_low, h_high, name=entity['name'], orientation='front', description=entity['description'])
+
+                global_y = place_left + anchor_y_left
+                update_collision_map(collision_map, global_x, global_y, entity_width, entity_length, stats)
+                return Rectangle(global_x, global_y, global_x + entity_width, global_y + entity_length,
+                                h_low, h_high, name=entity['name'], orientation=chosen_surface.split('_')[0],
+                                description=entity['description'])
 
             surfaces.remove(chosen_surface)
             
         return None
 
-def place_corner(entity, collision_map):
+def place_corner(entity, collision_map, exhaustive=False, rng=random, stats=None):
     entity_length, entity_width, entity_height = entity['dimensions']
     corner = ['left_back', 'left_front', 'right_back', 'right_front']
+    # corners are the outer quarter of the stage on each axis
+    stage_depth, stage_width = collision_map.shape
+    corner_x, corner_y = stage_width // 4, stage_depth // 4
     
-    if (250 - entity_length <= 0) or (250 - entity_width <= 0):
-        print(f"Entity {entity['name']} is too large to fit in the corner area.")
+    if (min(corner_x, corner_y) - entity_length <= 0) or (min(corner_x, corner_y) - entity_width <= 0):
+        note(stats, 'notes', f"Entity {entity['name']} is too large to fit in the corner area.")
         return None  
     
     while corner:
-        chosen_corner = random.choice(corner)
-        SEARCH_ATTEMPTS = 5000 
-        for _ in range(SEARCH_ATTEMPTS):
-            orientation = random.choice(['front', 'right'])
+        chosen_corner = rng.choice(corner)
+        note(stats, 'surfaces', chosen_corner)
+        candidates = []
+        for orientation in ['front', 'right']:
             if orientation == 'front':
                 x = entity_length
                 y = entity_width
@@ -345,113 +388,293 @@ def place_corner(entity, collision_map):
                 y = entity_length
  
             if chosen_corner == 'left_back':
-                place_left = random.randint(0, 250 - x)
-                place_back = random.randint(0, 250 - y)
-
+                candidates.append((orientation, 0, corner_x - x, 0, corner_y - y, x, y))
             elif chosen_corner == 'left_front':
-                place_left = random.randint(0, 250 - x)
-                place_back = random.randint(750, 999 - y)
-
+                candidates.append((orientation, 0, corner_x - x, stage_depth - corner_y, stage_depth - 1 - y, x, y))
             elif chosen_corner == 'right_back':
-                place_left = random.randint(750, 999 - x)
-                place_back = random.randint(0, 999 - y)
-
+                candidates.append((orientation, stage_width - corner_x, stage_width - 1 - x, 0, stage_depth - 1 - y, x, y))
             else:  # 'right_front'
-                place_left = random.randint(750, 999 - x)
-                place_back = random.randint(750, 999 - y)
-
-
-            if is_valid_position(place_left, place_back, x, y, collision_map):
-                update_collision_map(collision_map, place_left, place_back, x, y)
-                return Rectangle(
-                    place_left,
-                    place_back,
-                    place_left + x,
-                    place_back + y,
-                    0,
-                    0 + entity_height,
-                    name=entity['name'],
-                    orientation=orientation,
-                    description=entity['description']
-                )
-        corner.remove(chosen_corner)
-    return None
-
-def place_center(entity, collision_map):
-    entity_length, entity_width, entity_height = entity['dimensions']
-    if (749 - entity_length <= 250) or (749 - entity_width <= 250):
-        print(f"Entity {entity['name']} is too large to fit in the central area.")
-        return None  
-    SEARCH_ATTEMPTS = 5000  
-    for _ in range(SEARCH_ATTEMPTS):
-        orientation = random.choice(['front', 'left', 'right'])
-        if orientation == 'front':
-            x = entity_length
-            y = entity_width
-        elif orientation == 'left'or orientation == 'right':
-            x = entity_width
-            y = entity_length  
-            
-        place_left = random.randint(250, 749 - x)
-        place_back = random.randint(250, 749 - y)
-        if is_valid_position(place_left, place_back, x, y, collision_map):
-            update_collision_map(collision_map, place_left, place_back, x, y)
+                candidates.append((orientation, stage_width - corner_x, stage_width - 1 - x,
+                                   stage_depth - corner_y, stage_depth - 1 - y, x, y))
+
+        found = search_position(collision_map, candidates, exhaustive, rng, stats)
+        if found:
+            orientation, place_left, place_back = found
+            x, y = (entity_length, entity_width) if orientation == 'front' else (entity_width, entity_length)
+            update_collision_map(collision_map, place_left, place_back, x, y, stats)
             return Rectangle(
                 place_left,
                 place_back,
                 place_left + x,
                 place_back + y,
                 0,
-                entity_height,
+                0 + entity_height,
                 name=entity['name'],
                 orientation=orientation,
                 description=entity['description']
             )
+        corner.remove(chosen_corner)
     return None
 
-def place_entities(anchor_entities, non_anchor_entities, floor_collision_map, successful_placements):
-    for entity in anchor_entities:
-        successful_placements.append({
-            "name": entity.name,
-            "orientation": entity.orientation,
-            "position": entity.get_bounding_box(),
-            "description": entity.description
-        })
-    for entity in non_anchor_entities:
-        anchor_name = entity["anchor_name"]
-        anchor = next((a for a in anchor_entities if a.name == anchor_name), None)
-        if not anchor:
-            if 'place_corner' in entity["placement_rule"]:
-                entity_rectangle = place_corner(entity, floor_collision_map)
-            elif 'place_center' in entity["placement_rule"]:
-                entity_rectangle = place_center(entity, floor_collision_map)
+def place_center(entity, collision_map, exhaustive=False, rng=random, stats=None):
+    entity_length, entity_width, entity_height = entity['dimensions']
+    # the center is the middle half of the stage on each axis
+    stage_depth, stage_width = collision_map.shape
+    x_low, x_high = stage_width // 4, stage_width - stage_width // 4 - 1
+    y_low, y_high = stage_depth // 4, stage_depth - stage_depth // 4 - 1
+    if (min(x_high - entity_length - x_low, y_high - entity_length - y_low) <= 0) or \
+       (min(x_high - entity_width - x_low, y_high - entity_width - y_low) <= 0):
+        note(stats, 'notes', f"Entity {entity['name']} is too large to fit in the central area.")
+        return None  
+    note(stats, 'surfaces', 'center')
+    candidates = []
+    for orientation in ['front', 'left', 'right']:
+        if orientation == 'front':
+            x = entity_length
+            y = entity_width
         else:
-            entity_rectangle = place_entity(anchor, entity, floor_collision_map)
+            x = entity_width
+            y = entity_length
+        candidates.append((orientation, x_low, x_high - x, y_low, y_high - y, x, y))
+
+    found = search_position(collision_map, candidates, exhaustive, rng, stats)
+    if found:
+        orientation, place_left, place_back = found
+        x, y = (entity_length, entity_width) if orientation == 'front' else (entity_width, entity_length)
+        update_collision_map(collision_map, place_left, place_back, x, y, stats)
+        return Rectangle(
+            place_left,
+            place_back,
+            place_left + x,
+            place_back + y,
+            0,
+            entity_height,
+            name=entity['name'],
+            orientation=orientation,
+            description=entity['description']
+        )
+    return None
+
+def place_non_anchor(entity, anchor, floor_collision_map, exhaustive=False, rng=random, stats=None):
+    if anchor:
+        return place_entity(anchor, entity, floor_collision_map, exhaustive, rng, stats)
+    kind = get_rule(entity).kind
+    if kind == 'place_corner':
+        return place_corner(entity, floor_collision_map, exhaustive, rng, stats)
+    if kind == 'place_center':
+        return place_center(entity, floor_collision_map, exhaustive, rng, stats)
+    return None
+
+def timed_place(entity, anchor, floor_collision_map, exhaustive=False, rng=random, stats=None):
+    """place_non_anchor that also adds its wall-clock time to stats['seconds']."""
+    start = time.perf_counter()
+    rectangle = place_non_anchor(entity, anchor, floor_collision_map, exhaustive, rng, stats)
+    if stats is not None:
+        stats['seconds'] = stats.get('seconds', 0.0) + time.perf_counter() - start
+    return rectangle
+
+def placement_record(entity, anchor, rectangle, stats):
+    """JSON-serializable summary of one entity's placement, the unit passed to a sink."""
+    return {
+        "name": entity['name'],
+        "rule": get_rule(entity).kind,
+        "placement_rule": entity.get('placement_rule'),
+        "anchor": anchor.name if anchor is not None else None,
+        "surfaces": stats.get('surfaces', []),
+        "attempts": stats.get('attempts', 0),
+        "seconds": stats.get('seconds', 0.0),
+        "placed": rectangle is not None,
+        "position": rectangle.get_bounding_box() if rectangle is not None else None,
+        "notes": stats.get('notes', [])
+    }
+
+def print_sink(record):
+    """Default sink, prints what the placement functions used to print."""
+    for message in record['notes']:
+        print(message)
+    if record['placed']:
+        print(f"Placed {record['name']} at {record['position']}.")
+    else:
+        print(f"Failed to place {record['name']}, no available position found.")
+
+def place_entities(anchor_entities, non_anchor_entities, floor_collision_map, successful_placements, exhaustive=False, rng=random,
+                   sink=print_sink, graph=None):
+    """
+    sink is called with the placement_record of every entity, in placement order. graph is the
+    SceneGraph of the entities, built if not given, and gets every placed box recorded.
+    """
+    for entity in anchor_entities:
+        successful_placements.append(entity.to_placement())
+    graph = graph or SceneGraph(anchor_entities, non_anchor_entities)
+    for i, entity in enumerate(non_anchor_entities):
+        stats = {}
+        entity_rectangle = timed_place(entity, graph.anchor_of(i), floor_collision_map, exhaustive, rng, stats)
+        graph.record(i, entity_rectangle)
+        sink(placement_record(entity, graph.anchor_of(i), entity_rectangle, stats))
 
         if entity_rectangle:
-            successful_placements.append({
-                "name": entity_rectangle.name,
-                "orientation": entity_rectangle.orientation,
-                "position": entity_rectangle.get_bounding_box(),
-                "description": entity_rectangle.description
-            })
-            entity_rectangle = None
-        else:
-            print(f"Failed to place {entity['name']}, no available position found.")
+            successful_placements.append(entity_rectangle.to_placement())
 
     return successful_placements
 
-def layout(anchor_text, ornament_text):
-    floor_collision_map = initialize_collision_map(1000, 1000)
+MAX_BACKTRACKS = 50
+MAX_BACKTRACK_DEPTH = 3
+
+def snapshot_state(floor_collision_map, anchor_entities):
+    surfaces = [{surface: surface_map.copy() if surface_map is not None else None
+                 for surface, surface_map in anchor.surface_collision_maps.items()} for anchor in anchor_entities]
+    return floor_collision_map.copy(), surfaces
+
+def restore_state(snapshot, floor_collision_map, anchor_entities):
+    floor_snapshot, surfaces = snapshot
+    floor_collision_map.restore(floor_snapshot)
+    for anchor, anchor_surfaces in zip(anchor_entities, surfaces):
+        for surface, surface_map in anchor_surfaces.items():
+            current = anchor.surface_collision_maps[surface]
+            if surface_map is None:
+                anchor.surface_collision_maps[surface] = None
+            elif current is None:
+                anchor.surface_collision_maps[surface] = surface_map.copy()
+            else:
+                current.restore(surface_map)
+
+def constraint_tightness(entity, anchor, floor_collision_map):
+    """Share of the region a rule can use that the entity footprint takes, higher is harder to place."""
+    entity_length, entity_width, entity_height = entity['dimensions']
+    kind = get_rule(entity).kind
+    stage_depth, stage_width = floor_collision_map.shape
+    if anchor is not None:
+        anchor_length, anchor_width = anchor.x_right - anchor.x_left, anchor.y_right - anchor.y_left
+        if kind == 'place_top':
+            return entity_length * entity_width / max(1, anchor_length * anchor_width)
+        if kind == 'place_attach':
+            return entity_length * entity_height / max(1, max(anchor_length, anchor_width) * (anchor.height_high - anchor.height_low))
+        # place_beside searches a 150 cm ring around the anchor
+        return entity_length * entity_width / max(1, (anchor_length + 300) * (anchor_width + 300) - anchor_length * anchor_width)
+    if kind == 'place_corner':
+        return entity_length * entity_width / max(1, 4 * (stage_width // 4) * (stage_depth // 4))
+    return entity_length * entity_width / max(1, (stage_width // 2) * (stage_depth // 2))
+
+def place_entities_backtracking(anchor_entities, non_anchor_entities, floor_collision_map, successful_placements,
+                                exhaustive=False, rng=random, max_backtracks=MAX_BACKTRACKS, max_depth=MAX_BACKTRACK_DEPTH,
+                                sink=print_sink, graph=None):
+    """
+    Same contract as place_entities, but entities are placed tightest and largest first. When one
+    fails, the last 1..max_depth placements are undone so it can go first and the undone ones
+    are placed again after it. A trial that loses any entity is rolled back, so backtracking never
+    drops an entity that was already placed; max_backtracks bounds the number of trials.
+    The records passed to sink sum the attempts and time of every try of an entity.
+    """
+    for entity in anchor_entities:
+        successful_placements.append(entity.to_placement())
+    graph = graph or SceneGraph(anchor_entities, non_anchor_entities)
+
+    def priority(i):
+        entity_length, entity_width, entity_height = non_anchor_entities[i]['dimensions']
+        return (constraint_tightness(non_anchor_entities[i], graph.anchor_of(i), floor_collision_map),
+                entity_length * entity_width)
+
+    stats = [{} for _ in non_anchor_entities]
+
+    def place(i):
+        return timed_place(non_anchor_entities[i], graph.anchor_of(i), floor_collision_map, exhaustive, rng, stats[i])
+
+    placed = []  # (entity index, state before it was placed)
+    results = [None] * len(non_anchor_entities)
+    for i in sorted(range(len(non_anchor_entities)), key=priority, reverse=True):
+        current = snapshot_state(floor_collision_map, anchor_entities)
+        results[i] = place(i)
+        if results[i]:
+            placed.append((i, current))
+            continue
+
+        for depth in range(1, min(max_depth, len(placed)) + 1):
+            if max_backtracks <= 0:
+                break
+            max_backtracks -= 1
+            undone = [j for j, _ in placed[-depth:]]
+            restore_state(placed[-depth][1], floor_collision_map, anchor_entities)
+            trial = []
+            for k in [i] + undone:
+                before = snapshot_state(floor_collision_map, anchor_entities)
+                rectangle = place(k)
+                if rectangle is None:
+                    break
+                trial.append((k, before, rectangle))
+            if len(trial) == depth + 1:
+                del placed[-depth:]
+                for k, before, rectangle in trial:
+                    placed.append((k, before))
+                    results[k] = rectangle
+                break
+            restore_state(current, floor_collision_map, anchor_entities)
+
+    for i, entity in enumerate(non_anchor_entities):
+        graph.record(i, results[i])
+        sink(placement_record(entity, graph.anchor_of(i), results[i], stats[i]))
+        if results[i]:
+            successful_placements.append(results[i].to_placement())
+
+    return successful_placements
+
+SLACK_MARGIN = 20
+
+def collision_slack(collision_map, boxes, margin=SLACK_MARGIN):
+    """Mean free share of the margin-wide ring around each footprint of boxes, rows in get_bounding_box order, on the floor map."""
+    ratios = []
+    for x_left, y_left, x_right, y_right, _, _ in boxes:
+        x, y = math.floor(x_left), math.floor(y_left)
+        h, w = math.ceil(x_right) - x, math.ceil(y_right) - y
+        ring = collision_map.area(x - margin, y - margin, h + 2 * margin, w + 2 * margin) - collision_map.area(x, y, h, w)
+        if ring <= 0:
+            continue
+        occupied = collision_map.count(x - margin, y - margin, h + 2 * margin, w + 2 * margin) - collision_map.count(x, y, h, w)
+        ratios.append(1 - occupied / ring)
+    return sum(ratios) / len(ratios) if ratios else 1.0
+
+SOLVERS = {'greedy': place_entities, 'backtracking': place_entities_backtracking}
+
+def layout_candidate(anchor_text, ornament_text, seed, exhaustive=False, stage_size=STAGE_SIZE, resolution=1, solver='greedy'):
+    """One independent placement with its own maps and random stream. Returns (score, placements, records)."""
+    rng = random.Random(seed)
+    floor_collision_map = initialize_floor_map(stage_size, resolution)
     anchor_entities, non_anchor_entities = parse_anchor_prompt_data(anchor_text, floor_collision_map)
     non_anchor_entities = parse_ornament_prompt_data(ornament_text, non_anchor_entities)
-    print("anchor_entities:",anchor_entities)
-    print("non_anchor_entities",non_anchor_entities)
+    graph = SceneGraph(anchor_entities, non_anchor_entities)
     successful_placements = []
-    successful_placements = place_entities(anchor_entities, non_anchor_entities, floor_collision_map, successful_placements)
-    for placement in successful_placements:
-        print(f"Placed {placement['name']} at {placement['position']}. description: {placement['description']}")
-    return successful_placements    
+    records = []
+    successful_placements = SOLVERS[solver](anchor_entities, non_anchor_entities, floor_collision_map, successful_placements,
+                                            exhaustive, rng, sink=records.append, graph=graph)
+    slack = collision_slack(floor_collision_map, graph.placed_entity_boxes())
+    return (len(successful_placements), slack), successful_placements, records
+
+def layout(anchor_text, ornament_text, exhaustive=False, seed=None, n_candidates=1, workers=1,
+           stage_size=STAGE_SIZE, resolution=1, solver='greedy', sink=print_sink):
+    """
+    Runs n_candidates placements seeded with seed, seed + 1, ... and keeps the one with the
+    most placed entities, breaking ties by collision slack. Returns (placements, seed) where
+    layout(..., seed=seed) reproduces the chosen placements.
+    stage_size is the (width, depth) of the stage floor in cm and resolution the floor grid
+    cell size in cm. solver is 'greedy' (LLM output order, no revisiting) or 'backtracking'.
+    Only the placement records of the chosen candidate are passed to sink.
+    """
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    seeds = [seed + i for i in range(n_candidates)]
+    candidate = partial(layout_candidate, anchor_text, ornament_text, exhaustive=exhaustive,
+                        stage_size=stage_size, resolution=resolution, solver=solver)
+    if workers > 1 and n_candidates > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=min(workers, n_candidates)) as executor:
+            results = list(executor.map(candidate, seeds))
+    else:
+        results = [candidate(candidate_seed) for candidate_seed in seeds]
+
+    best = max(range(n_candidates), key=lambda i: results[i][0])
+    score, successful_placements, records = results[best]
+    for record in records:
+        sink(record)
+    return successful_placements, seeds[best]
 
 def main():
     anchor_text = """
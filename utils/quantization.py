@@ -0,0 +1,155 @@
+"""
+Int8 asset features with one float32 scale per vector.
+
+    python -m utils.quantization --features_dir ~/.objathor-assets/2023_09_23/features
+    python -m utils.quantization --features_dir <same dir> --report --queries queries.txt --output report.json
+
+The first command writes clip_features_int8.npy, clip_scales.npy, sbert_features_int8.npy and
+sbert_scales.npy next to the features, a quarter of the float32 size. The retriever only scores
+them on top of the utils.feature_store files, whose float memmaps are then left on disk. x is stored as
+round(x / scale) with scale = max|x| / 127, so a dot product with x is scale times the dot
+product with the codes. The second loads the retriever and compares retrieve_topk with the
+float32 and the int8 features: recall@k of the float32 top-k and the drift of the scores.
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from utils.feature_store import has_feature_store, load_features, load_pickled_features
+
+CLIP_CODES_FILE = "clip_features_int8.npy"
+CLIP_SCALES_FILE = "clip_scales.npy"
+SBERT_CODES_FILE = "sbert_features_int8.npy"
+SBERT_SCALES_FILE = "sbert_scales.npy"
+
+DEFAULT_QUERIES = [
+    "a 3D model of chair, A simple wooden chair with a soft cushion.",
+    "a 3D model of table, A rectangular wooden table with a polished oak finish.",
+    "a 3D model of floor_lamp, A tall, modern-style floor lamp with a black metal frame.",
+    "a 3D model of vase, A modern ceramic vase with a slender body.",
+    "a 3D model of sofa, A three-seat fabric sofa in dark green.",
+    "a 3D model of bookshelf, A tall bookshelf filled with old books.",
+    "a 3D model of statue, A small marble statue of a seated figure.",
+    "a 3D model of bed, A double bed with white linen.",
+    "a 3D model of window, A large French-style window with white-painted wooden frames.",
+    "a 3D model of door, A modern-style door with a frosted glass center panel.",
+]
+
+
+def has_int8_store(features_dir):
+    return all(os.path.exists(os.path.join(features_dir, name))
+               for name in (CLIP_CODES_FILE, CLIP_SCALES_FILE, SBERT_CODES_FILE, SBERT_SCALES_FILE))
+
+
+def quantize(features, chunk=4096):
+    """(codes, scales): int8 codes of the same shape and one float32 scale per vector of the last axis."""
+    codes = np.empty(features.shape, dtype=np.int8)
+    scales = np.empty(features.shape[:-1], dtype=np.float32)
+    for start in range(0, len(features), chunk):
+        block = np.asarray(features[start:start + chunk], dtype=np.float32)
+        block_scales = np.maximum(np.abs(block).max(axis=-1), 1e-12) / 127
+        codes[start:start + chunk] = np.clip(np.rint(block / block_scales[..., None]), -127, 127)
+        scales[start:start + chunk] = block_scales
+    return codes, scales
+
+
+def dequantize(codes, scales):
+    return codes.astype(np.float32) * scales[..., None]
+
+
+def convert_int8(features_dir):
+    if has_feature_store(features_dir):
+        uids, clip_features, sbert_features = load_features(features_dir)
+    else:
+        uids, clip_features, sbert_features = load_pickled_features(features_dir)
+    for features, codes_file, scales_file in ((clip_features, CLIP_CODES_FILE, CLIP_SCALES_FILE),
+                                              (sbert_features, SBERT_CODES_FILE, SBERT_SCALES_FILE)):
+        codes, scales = quantize(features)
+        np.save(os.path.join(features_dir, codes_file), codes)
+        np.save(os.path.join(features_dir, scales_file), scales)
+    return len(uids)
+
+
+def load_int8(features_dir):
+    """(clip codes, clip scales, sbert codes, sbert scales) as read-only memmaps."""
+    return tuple(np.load(os.path.join(features_dir, name), mmap_mode="r")
+                 for name in (CLIP_CODES_FILE, CLIP_SCALES_FILE, SBERT_CODES_FILE, SBERT_SCALES_FILE))
+
+
+def recall_report(retriever, queries, k=10, threshold=None):
+    """
+    retrieve_topk with float32 and with int8 features on the same retriever. recall_at_k is the
+    share of the float32 top-k found in the int8 top-k, score drift compares the scores of the
+    assets found by both.
+    """
+    quantized = retriever.quantized
+    try:
+        retriever.quantized = False
+        exact = retriever.retrieve_topk(queries, k, threshold)
+        retriever.quantized = True
+        approximate = retriever.retrieve_topk(queries, k, threshold)
+    finally:
+        retriever.quantized = quantized
+
+    recalls, drifts = [], []
+    for i in range(len(queries)):
+        exact_scores = {index: score for index, score in zip(exact.indices[i], exact.scores[i]) if index >= 0}
+        approximate_scores = {index: score for index, score in zip(approximate.indices[i], approximate.scores[i]) if index >= 0}
+        if exact_scores:
+            recalls.append(len(exact_scores.keys() & approximate_scores.keys()) / len(exact_scores))
+        drifts += [abs(float(approximate_scores[index] - score)) for index, score in exact_scores.items()
+                   if index in approximate_scores]
+    return {
+        "queries": len(queries),
+        "k": k,
+        f"recall_at_{k}": float(np.mean(recalls)) if recalls else None,
+        "score_drift": {
+            "mean": float(np.mean(drifts)) if drifts else None,
+            "max": float(np.max(drifts)) if drifts else None
+        },
+        "feature_bytes": {
+            "float32": int(4 * (retriever.clip_features.numel() + retriever.sbert_features.numel())),
+            "int8": int(retriever.clip_codes.numel() + retriever.sbert_codes.numel()
+                        + 4 * (retriever.clip_scales.numel() + retriever.sbert_scales.numel()))
+        }
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Quantize the asset features to int8 and report the retrieval drift")
+    parser.add_argument("--features_dir", type=str, required=True, help="Directory of the asset features")
+    parser.add_argument("--report", action="store_true", help="Compare float32 and int8 retrieval instead of converting")
+    parser.add_argument("--queries", type=str, default=None, help="Text file with one query per line for the report")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--threshold", type=float, default=27)
+    parser.add_argument("--output", type=str, default=None, help="Write the report here instead of stdout")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if not args.report:
+        count = convert_int8(args.features_dir)
+        print(f"Wrote int8 features of {count} assets to {args.features_dir}")
+        return
+
+    from retrieve_obj import load_retriever
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+    retriever = load_retriever(embedding_cache_dir=None, quantized=True, features_dir=args.features_dir)
+    report = recall_report(retriever, queries, args.k, args.threshold)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+    else:
+        print(json.dumps(report, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,255 @@
+"""
+Long-lived asset retrieval server on a Unix socket.
+
+    python -m utils.retrieval_server --socket /tmp/stagedesigner-retrieval.sock
+
+loads the text encoders and the asset features once and answers retrieve_candidates requests
+from stage_generator runs. The protocol is one JSON object per line in each direction.
+Requests that arrive within max_wait_ms of each other are scored as one batch, so concurrent
+pipelines share the encoder and similarity passes. connect_retriever returns a client with
+the retrieve_candidates signature of ObjathorRetriever, or None when no server answers, in
+which case the caller loads the retriever in-process. The server reports the retrieval
+options it was started with in its ping answer, so callers can tell when they differ from
+their own.
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+
+RETRIEVAL_SOCKET = os.environ.get("RETRIEVAL_SOCKET", "/tmp/stagedesigner-retrieval.sock")
+MAX_WAIT_MS = 5
+MAX_BATCH_QUERIES = 512
+
+
+def validate(request):
+    """Raises ValueError unless request is a retrieve_candidates request the batcher can run."""
+    if not isinstance(request, dict):
+        raise ValueError("request must be a JSON object")
+    queries = request.get("queries")
+    if not isinstance(queries, list) or not all(isinstance(query, str) for query in queries):
+        raise ValueError("queries must be a list of strings")
+    k = request.get("k", 10)
+    if not isinstance(k, int) or isinstance(k, bool) or k < 1:
+        raise ValueError("k must be a positive integer")
+    threshold = request.get("threshold")
+    if threshold is not None and (not isinstance(threshold, (int, float)) or isinstance(threshold, bool)):
+        raise ValueError("threshold must be a number")
+    sizes = request.get("sizes")
+    if sizes is not None:
+        if not isinstance(sizes, list) or len(sizes) != len(queries):
+            raise ValueError("sizes must hold one size per query")
+        for size in sizes:
+            if (not isinstance(size, list) or len(size) != 3
+                    or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in size)):
+                raise ValueError("each size must be a (length, width, height) list of numbers")
+
+
+def query_count(request):
+    queries = request.get("queries") if isinstance(request, dict) else None
+    return len(queries) if isinstance(queries, list) else 0
+
+
+class Job:
+    def __init__(self, request):
+        self.request = request
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchingRetriever:
+    """Runs the requests queued by all connections as one retrieve_candidates call per (k, threshold, sized) group."""
+
+    def __init__(self, retriever, max_wait=MAX_WAIT_MS / 1000, max_batch_queries=MAX_BATCH_QUERIES):
+        self.retriever = retriever
+        self.max_wait = max_wait
+        self.max_batch_queries = max_batch_queries
+        self.jobs = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, request):
+        job = Job(request)
+        self.jobs.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def collect(self):
+        batch = [self.jobs.get()]
+        queries = query_count(batch[0].request)
+        deadline = time.monotonic() + self.max_wait
+        while queries < self.max_batch_queries:
+            try:
+                job = self.jobs.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            batch.append(job)
+            queries += query_count(job.request)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            try:
+                self.run_batch(batch)
+            except Exception as error:
+                # whatever went wrong, the jobs of this batch get an answer and the thread keeps serving
+                for job in batch:
+                    if not job.done.is_set():
+                        job.error = error
+                        job.done.set()
+
+    def run_batch(self, batch):
+        groups = {}
+        for job in batch:
+            try:
+                validate(job.request)
+            except ValueError as error:
+                job.error = error
+                job.done.set()
+                continue
+            request = job.request
+            groups.setdefault((request.get("k", 10), request.get("threshold"), request.get("sizes") is not None), []).append(job)
+        for (k, threshold, sized), jobs in groups.items():
+            queries = [query for job in jobs for query in job.request["queries"]]
+            sizes = [size for job in jobs for size in job.request["sizes"]] if sized else None
+            try:
+                results = self.retriever.retrieve_candidates(queries, k, threshold, sizes) if queries else []
+            except Exception as error:
+                for job in jobs:
+                    job.error = error
+                    job.done.set()
+                continue
+            start = 0
+            for job in jobs:
+                job.result = results[start:start + len(job.request["queries"])]
+                start += len(job.request["queries"])
+                job.done.set()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if isinstance(request, dict) and request.get("method") == "ping":
+                    response = {"ok": True, "options": self.server.options}
+                else:
+                    validate(request)
+                    response = {"candidates": self.server.batcher.submit(request)}
+            except Exception as error:
+                response = {"error": repr(error)}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def socket_id(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino, stat.st_ctime_ns  # inode numbers get reused once a file is gone
+
+
+class RetrievalServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, retriever, max_wait=MAX_WAIT_MS / 1000, options=None):
+        if connect_retriever(socket_path, timeout=5) is not None:
+            raise RuntimeError(f"A retrieval server is already listening on {socket_path}")
+        if os.path.exists(socket_path):
+            os.remove(socket_path)  # left behind by a server that did not shut down cleanly
+        super().__init__(socket_path, RequestHandler)
+        self.socket_id = socket_id(socket_path)
+        self.options = options or {}
+        self.batcher = BatchingRetriever(retriever, max_wait)
+
+    def remove_socket(self):
+        """Unlinks the socket file unless another server has replaced it since this one bound it."""
+        if socket_id(self.server_address) == self.socket_id:
+            os.remove(self.server_address)
+
+
+class RemoteRetriever:
+    def __init__(self, socket_path=RETRIEVAL_SOCKET, timeout=600):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.options = {}  # retrieval options of the server, from its ping answer
+
+    def call(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            connection.connect(self.socket_path)
+            connection.sendall((json.dumps(request) + "\n").encode("utf-8"))
+            with connection.makefile("rb") as response:
+                return json.loads(response.readline())
+
+    def retrieve_candidates(self, queries, k=10, threshold=None, sizes=None):
+        """Same contract as ObjathorRetriever.retrieve_candidates."""
+        response = self.call({"method": "retrieve_candidates", "queries": list(queries), "k": k,
+                              "threshold": threshold, "sizes": sizes})
+        if "error" in response:
+            raise RuntimeError(f"Retrieval server error: {response['error']}")
+        return [[(uid, score) for uid, score in candidates] for candidates in response["candidates"]]
+
+    def mismatched_options(self, options):
+        """The options set (not None or False) in options that the server was started with a different value of."""
+        return {name: value for name, value in options.items()
+                if value not in (None, False) and self.options.get(name) != value}
+
+
+def connect_retriever(socket_path=RETRIEVAL_SOCKET, timeout=600):
+    if not socket_path or not os.path.exists(socket_path):
+        return None
+    retriever = RemoteRetriever(socket_path, timeout)
+    try:
+        retriever.options = retriever.call({"method": "ping"}).get("options", {})
+    except (OSError, ValueError):
+        return None
+    return retriever
+
+
+def parse_arguments():
+    from utils.embedding_cache import EMBEDDING_CACHE_DIR
+
+    parser = argparse.ArgumentParser(description="Serve asset retrieval on a Unix socket")
+    parser.add_argument("--socket", type=str, default=RETRIEVAL_SOCKET, help="Path of the Unix socket")
+    parser.add_argument("--ann_nprobe", type=int, default=None, help="Probe this many IVF lists, exact search if not given")
+    parser.add_argument("--retrieval_shards", type=int, default=None, help="Score only this many category shards")
+    parser.add_argument("--embedding_cache_dir", type=str, default=EMBEDDING_CACHE_DIR, help="Directory of cached query embeddings")
+    parser.add_argument("--int8_features", action="store_true", help="Score the int8 features of utils.quantization")
+    parser.add_argument("--retrieval_prefilter", type=int, default=None, help="Exact scores only for this many assets per query")
+    parser.add_argument("--score_threads", type=int, default=None, help="Threads scoring blocks of assets in parallel")
+    parser.add_argument("--max_wait_ms", type=float, default=MAX_WAIT_MS, help="How long a request waits for others to batch with")
+    return parser.parse_args()
+
+
+def main():
+    from retrieve_obj import load_retriever
+
+    args = parse_arguments()
+    if connect_retriever(args.socket, timeout=5) is not None:
+        raise SystemExit(f"A retrieval server is already listening on {args.socket}")
+    retriever = load_retriever(args.ann_nprobe, args.embedding_cache_dir, args.retrieval_shards,
+                               quantized=args.int8_features, prefilter=args.retrieval_prefilter,
+                               score_threads=args.score_threads)
+    options = {"ann_nprobe": args.ann_nprobe, "retrieval_shards": args.retrieval_shards,
+               "int8_features": args.int8_features, "retrieval_prefilter": args.retrieval_prefilter,
+               "score_threads": args.score_threads}
+    with RetrievalServer(args.socket, retriever, args.max_wait_ms / 1000, options) as server:
+        print(f"Serving retrieval on {args.socket}")
+        try:
+            server.serve_forever()
+        finally:
+            server.remove_socket()
+
+
+if __name__ == "__main__":
+    main()
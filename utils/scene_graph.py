@@ -0,0 +1,89 @@
+import re
+from collections import namedtuple
+
+import numpy as np
+
+# kind is the rule name, e.g. 'place_attach'; anchor is the anchor named in the rule or None;
+# h_low / h_high are only set for place_attach
+PlacementRule = namedtuple('PlacementRule', ['kind', 'anchor', 'h_low', 'h_high'])
+
+RULE_PATTERN = re.compile(r'(place_[a-z]+)\s*\((.*)\)', re.S)
+RULE_KINDS = ('place_beside', 'place_top', 'place_attach', 'place_corner', 'place_center')
+
+
+def parse_placement_rule(text):
+    match = RULE_PATTERN.search(text)
+    if not match or match.group(1) not in RULE_KINDS:
+        return PlacementRule(None, None, None, None)
+    kind = match.group(1)
+    args = [arg.strip() for arg in match.group(2).split(',') if arg.strip()]
+
+    if kind in ('place_beside', 'place_top'):
+        return PlacementRule(kind, args[0] if args else None, None, None)
+    if kind == 'place_attach':
+        numbers = [int(arg) for arg in args if re.fullmatch(r'-?\d+', arg)]
+        names = [arg for arg in args if not re.fullmatch(r'-?\d+', arg)]
+        h_low, h_high = numbers[:2] if len(numbers) >= 2 else (None, None)
+        return PlacementRule(kind, names[0] if names else None, h_low, h_high)
+    return PlacementRule(kind, None, None, None)
+
+
+def get_rule(entity):
+    """Parsed rule of an entity dict, cached under entity['rule'] after the first call."""
+    rule = entity.get('rule')
+    if rule is None:
+        rule = entity['rule'] = parse_placement_rule(entity['placement_rule'])
+    return rule
+
+
+class SceneGraph:
+    """
+    Compiled view of a parsed scene: typed rules, a name -> anchor index, anchor -> ornament
+    adjacency and the boxes of every entity as one (n_anchors + n_entities, 6) array in
+    get_bounding_box order. Anchors occupy the first rows, entity i is row n_anchors + i.
+    The solvers record their placements here and layout_candidate scores them from the array.
+    """
+
+    __slots__ = ('anchors', 'entities', 'rules', 'anchor_index', 'entity_anchor', 'children', 'boxes', 'placed')
+
+    def __init__(self, anchor_entities, non_anchor_entities):
+        self.anchors = anchor_entities
+        self.entities = non_anchor_entities
+        self.rules = [get_rule(entity) for entity in non_anchor_entities]
+
+        self.anchor_index = {}
+        for i, anchor in enumerate(anchor_entities):
+            # the first anchor wins on duplicate names, as the linear scan did
+            self.anchor_index.setdefault(anchor.name, i)
+
+        self.entity_anchor = np.full(len(non_anchor_entities), -1, dtype=np.intp)
+        self.children = [[] for _ in anchor_entities]
+        for i, entity in enumerate(non_anchor_entities):
+            anchor = self.anchor_index.get(entity.get('anchor_name'))
+            if anchor is not None:
+                self.entity_anchor[i] = anchor
+                self.children[anchor].append(i)
+
+        n_anchors = len(anchor_entities)
+        self.boxes = np.zeros((n_anchors + len(non_anchor_entities), 6), dtype=np.float64)
+        self.placed = np.zeros(n_anchors + len(non_anchor_entities), dtype=bool)
+        for i, anchor in enumerate(anchor_entities):
+            self.boxes[i] = anchor.get_bounding_box()
+            self.placed[i] = True
+
+    def anchor_of(self, i):
+        anchor = self.entity_anchor[i]
+        return self.anchors[anchor] if anchor >= 0 else None
+
+    def record(self, i, rectangle):
+        row = len(self.anchors) + i
+        if rectangle is None:
+            self.placed[row] = False
+        else:
+            self.boxes[row] = rectangle.get_bounding_box()
+            self.placed[row] = True
+
+    def placed_entity_boxes(self):
+        """(placed entities, 6) boxes of the non-anchor entities that were placed, in entity order."""
+        n_anchors = len(self.anchors)
+        return self.boxes[n_anchors:][self.placed[n_anchors:]]